@@ -0,0 +1,195 @@
+"""
+A local stand-in for a TP-Link Kasa device, speaking the TP-Link Smart Home JSON protocol over TCP (commands) and
+UDP (discovery) on port 9999, with configurable latency and failure injection.
+
+Each device listens on its own loopback address (e.g. 127.0.0.2), as the Kasa library always connects to port 9999.
+"""
+import asyncio
+import copy
+import json
+import random
+import struct
+from typing import Dict, Optional
+
+from kasa.protocol import TPLinkSmartHomeProtocol
+
+PORT: int = 9999
+
+LIGHT_SERVICE: str = "smartlife.iot.smartbulb.lightingservice"
+
+PLUG_SYS_INFO: Dict = {
+    "sw_ver": "1.5.4 Build 180815 Rel.121440",
+    "hw_ver": "2.0",
+    "model": "HS100(UK)",
+    "type": "IOT.SMARTPLUGSWITCH",
+    "mic_type": "IOT.SMARTPLUGSWITCH",
+    "dev_name": "Smart Wi-Fi Plug",
+    "relay_state": 0,
+    "on_time": 0,
+    "feature": "TIM",
+    "led_off": 0,
+    "rssi": -50,
+    "latitude_i": 0,
+    "longitude_i": 0,
+    "err_code": 0,
+}
+
+BULB_SYS_INFO: Dict = {
+    "sw_ver": "1.8.6 Build 180809 Rel.091659",
+    "hw_ver": "1.0",
+    "model": "LB130(EU)",
+    "description": "Smart Wi-Fi LED Bulb with Color Changing",
+    "mic_type": "IOT.SMARTBULB",
+    "dev_state": "normal",
+    "is_factory": False,
+    "is_dimmable": 1,
+    "is_color": 1,
+    "is_variable_color_temp": 1,
+    "light_state": {"on_off": 0, "dft_on_state": {"mode": "normal", "hue": 0, "saturation": 0,
+                                                  "color_temp": 2700, "brightness": 100}},
+    "preferred_state": [],
+    "rssi": -50,
+    "err_code": 0,
+}
+
+
+class FakeKasaDevice:
+    """
+    A fake plug or bulb. State changes (relay state, light state) are applied, so reads after writes are consistent.
+
+    :param host: The loopback address to listen on.
+    :param alias: The alias the device reports.
+    :param kind: 'plug' or 'bulb'.
+    :param latency: Seconds to wait before answering each request.
+    :param jitter: Up to this many extra seconds are added to the latency, at random.
+    :param failure_rate: The fraction of requests that fail. Reads fail by dropping the connection, and commands
+                         fail with an error code, as real devices do.
+    """
+
+    def __init__(self, host: str, alias: str, kind: str = "plug", latency: float = 0.0, jitter: float = 0.0,
+                 failure_rate: float = 0.0):
+        self.host = host
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+
+        self.sys_info: Dict = copy.deepcopy(BULB_SYS_INFO if kind == "bulb" else PLUG_SYS_INFO)
+        self.sys_info["alias"] = alias
+        self.sys_info["deviceId"] = self.sys_info["mac"] = self.sys_info["mic_mac"] = f"fake-{host}"
+
+        self.requests = 0
+        self._servers = []
+
+    @property
+    def is_bulb(self) -> bool:
+        return "light_state" in self.sys_info
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self._servers.append(await asyncio.start_server(self._handle_connection, self.host, PORT))
+        transport, _ = await loop.create_datagram_endpoint(lambda: _DiscoveryProtocol(self),
+                                                           local_addr=(self.host, PORT))
+        self._servers.append(transport)
+
+    async def stop(self):
+        for server in self._servers:
+            server.close()
+        self._servers = []
+
+    async def _delay(self):
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def _should_fail(self) -> bool:
+        return self.failure_rate > 0 and random.random() < self.failure_rate
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                length = struct.unpack(">I", await reader.readexactly(4))[0]
+                request = json.loads(TPLinkSmartHomeProtocol.decrypt(await reader.readexactly(length)))
+                self.requests += 1
+                await self._delay()
+
+                failed = self._should_fail()
+                if failed and _is_read(request):
+                    break
+
+                writer.write(TPLinkSmartHomeProtocol.encrypt(json.dumps(self.handle(request, failed))))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def handle(self, request: Dict, failed: bool = False) -> Dict:
+        """
+        Build the response to a request, applying any state changes it makes.
+
+        :param request: The decoded request, of the form {target: {command: args}}.
+        :param failed: Answer every command with an error code instead.
+        :return: The response, of the same form.
+        """
+        response = {}
+        for target, commands in request.items():
+            response[target] = {}
+            for command, args in (commands or {}).items():
+                if failed:
+                    result = {"err_code": -1, "err_msg": "injected failure"}
+                else:
+                    result = self._handle_command(target, command, args or {})
+                response[target][command] = result
+        return response
+
+    def _handle_command(self, target: str, command: str, args: Dict) -> Dict:
+        if target == "system" and command == "get_sysinfo":
+            return copy.deepcopy(self.sys_info)
+
+        if target == "system" and command == "set_relay_state" and not self.is_bulb:
+            self.sys_info["relay_state"] = args.get("state", 0)
+            return {"err_code": 0}
+
+        if target == LIGHT_SERVICE and self.is_bulb:
+            light_state = self.sys_info["light_state"]
+            if command == "transition_light_state":
+                # The settings are reported at the top level when the bulb is on, and under `dft_on_state` when off
+                if light_state["on_off"]:
+                    settings = {k: v for k, v in light_state.items() if k != "on_off"}
+                else:
+                    settings = light_state["dft_on_state"]
+                changes = {k: v for k, v in args.items() if k not in ("transition_period", "ignore_default")}
+                is_on = changes.pop("on_off", light_state["on_off"])
+                settings.update(changes)
+                light_state = {"on_off": 1, **settings} if is_on else {"on_off": 0, "dft_on_state": settings}
+                self.sys_info["light_state"] = light_state
+                return {**copy.deepcopy(light_state), "err_code": 0}
+            if command == "get_light_state":
+                return {**copy.deepcopy(light_state), "err_code": 0}
+
+        return {"err_code": -1, "err_msg": "module not support"}
+
+
+def _is_read(request: Dict) -> bool:
+    return "system" in request and "get_sysinfo" in (request["system"] or {})
+
+
+class _DiscoveryProtocol(asyncio.DatagramProtocol):
+    """
+    Answers discovery broadcasts, which are encrypted like the TCP requests but without the length prefix.
+    """
+
+    def __init__(self, device: FakeKasaDevice):
+        self.device = device
+        self.transport: Optional[asyncio.DatagramTransport] = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            request = json.loads(TPLinkSmartHomeProtocol.decrypt(data))
+        except ValueError:
+            return
+        response = self.device.handle(request)
+        self.transport.sendto(TPLinkSmartHomeProtocol.encrypt(json.dumps(response))[4:], addr)
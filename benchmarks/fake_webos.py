@@ -0,0 +1,151 @@
+"""
+A local stand-in for an LG webOS TV, serving the webOS websocket API (and the pointer input socket) on port 3000,
+with configurable latency and failure injection.
+
+Each TV listens on its own loopback address (e.g. 127.0.1.2), as pywebostv always connects to port 3000.
+"""
+import json
+import random
+import threading
+from typing import Dict, List, Tuple
+from wsgiref.simple_server import make_server
+
+from ws4py.server.wsgirefserver import WSGIServer, WebSocketWSGIRequestHandler
+from ws4py.server.wsgiutils import WebSocketWSGIApplication
+from ws4py.websocket import WebSocket
+
+PORT: int = 3000
+
+CLIENT_KEY: str = "fake-client-key"
+
+VOLUME_URI: str = "ssap://audio/getVolume"
+
+FOREGROUND_APP_URI: str = "ssap://com.webos.applicationManager/getForegroundAppInfo"
+
+APPS: List[Dict] = [
+    {"id": "netflix", "title": "Netflix"},
+    {"id": "youtube.leanback.v4", "title": "YouTube"},
+    {"id": "amazon", "title": "Prime Video"},
+    {"id": "com.webos.app.livetv", "title": "Live TV"},
+]
+
+
+class FakeWebOSTV:
+    """
+    A fake TV. Registration always succeeds, and hands out a fixed client key. Requests are answered with a canned
+    response for the URIs the adapter uses, and a bare success for any others. Subscribers to the volume or the
+    foreground app are sent the new value whenever a request changes it.
+
+    :param host: The loopback address to listen on.
+    :param latency: Seconds to wait before answering each request.
+    :param jitter: Up to this many extra seconds are added to the latency, at random.
+    :param failure_rate: The fraction of requests that are answered with an error.
+    """
+
+    def __init__(self, host: str, latency: float = 0.0, jitter: float = 0.0, failure_rate: float = 0.0):
+        self.host = host
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+
+        self.volume = 10
+        self.foreground_app = APPS[0]["id"]
+        self.requests = 0
+        self.key_presses = 0
+
+        # The subscriptions, as (websocket, subscription id, uri)
+        self._subscriptions: List[Tuple[WebSocket, str, str]] = []
+        self._lock = threading.Lock()
+
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        tv = self
+
+        class Handler(WebSocket):
+            def received_message(self, message):
+                tv._received(self, str(message))
+
+        self._server = make_server(self.host, PORT, server_class=WSGIServer,
+                                   handler_class=WebSocketWSGIRequestHandler,
+                                   app=WebSocketWSGIApplication(handler_cls=Handler))
+        self._server.initialize_websockets_manager()
+        self._thread = threading.Thread(target=self._server.serve_forever, name=f"FakeWebOSTV-{self.host}",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._server is None:
+            return
+        self._server.shutdown()
+        # Also closes the open websockets and stops their manager
+        self._server.server_close()
+        self._server = None
+
+    def _received(self, ws: WebSocket, message: str):
+        # Key presses on the pointer input socket are plain text, and get no response
+        if not message.startswith("{"):
+            self.key_presses += 1
+            return
+
+        self.requests += 1
+        request = json.loads(message)
+        if request["type"] == "subscribe":
+            with self._lock:
+                self._subscriptions.append((ws, request["id"], request["uri"]))
+
+        with self._lock:
+            volume, app = self.volume, self.foreground_app
+            response = self._respond(request)
+            changed = [uri for uri, changed in ((VOLUME_URI, self.volume != volume),
+                                                (FOREGROUND_APP_URI, self.foreground_app != app)) if changed]
+            notifications = [(sub_ws, self._notification(sub_id, uri)) for sub_ws, sub_id, uri in self._subscriptions
+                             if uri in changed]
+
+        # Answer off the websocket manager's thread, so that latency on one request doesn't hold up the others
+        delay = self.latency + random.uniform(0, self.jitter)
+        timer = threading.Timer(delay, self._send, args=([(ws, response)] + notifications,))
+        timer.daemon = True
+        timer.start()
+
+    def _send(self, messages: List[Tuple[WebSocket, Dict]]):
+        for ws, message in messages:
+            if ws.terminated:
+                with self._lock:
+                    self._subscriptions = [s for s in self._subscriptions if s[0] is not ws]
+            else:
+                ws.send(json.dumps(message))
+
+    def _notification(self, subscription_id: str, uri: str) -> Dict:
+        return {"type": "response", "id": subscription_id, "payload": {"returnValue": True, **self._handle(uri, {})}}
+
+    def _respond(self, request: Dict) -> Dict:
+        if request["type"] == "register":
+            return {"type": "registered", "id": request["id"], "payload": {"client-key": CLIENT_KEY}}
+
+        if self.failure_rate > 0 and random.random() < self.failure_rate:
+            payload = {"returnValue": False, "errorText": "injected failure"}
+        else:
+            payload = {"returnValue": True, **self._handle(request.get("uri", ""), request.get("payload", {}))}
+        return {"type": "response", "id": request["id"], "payload": payload}
+
+    def _handle(self, uri: str, payload: Dict) -> Dict:
+        if uri == "ssap://com.webos.service.networkinput/getPointerInputSocket":
+            return {"socketPath": f"ws://{self.host}:{PORT}/pointer"}
+        if uri == "ssap://com.webos.applicationManager/listApps":
+            return {"apps": APPS}
+        if uri == FOREGROUND_APP_URI:
+            return {"appId": self.foreground_app}
+        if uri == "ssap://system.launcher/launch":
+            self.foreground_app = payload.get("id", self.foreground_app)
+            return {"id": self.foreground_app}
+        if uri == VOLUME_URI:
+            return {"volume": self.volume, "muted": False}
+        if uri == "ssap://audio/setVolume":
+            self.volume = payload.get("volume", self.volume)
+        elif uri == "ssap://audio/volumeUp":
+            self.volume += 1
+        elif uri == "ssap://audio/volumeDown":
+            self.volume -= 1
+        return {}
@@ -0,0 +1,263 @@
+"""
+Benchmark the API against local fake devices, so that performance can be measured without real hardware.
+
+Starts fake Kasa devices and fake webOS TVs (see `fake_kasa` and `fake_webos`), points the adapters at them with a
+generated config, and serves the app with uvicorn as `main.py` does. Each scenario then drives one of the `/kasa/*`
+or `/lgtv/*` routes with concurrent requests, and the throughput and p50/p99 latency are reported.
+
+Run from the repository root, e.g.
+
+    python -m benchmarks.run --kasa-devices 8 --tvs 2 --concurrency 16 --latency 0.02 --failure-rate 0.05
+
+The fakes listen on addresses in 127.0.0.0/8 other than 127.0.0.1, which Linux routes to the loopback interface.
+Other platforms need those addresses adding as loopback aliases first.
+"""
+import argparse
+import http.client
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import quote
+
+import toml
+import uvicorn
+
+import under_control
+from benchmarks.fake_kasa import FakeKasaDevice
+from benchmarks.fake_webos import CLIENT_KEY, FakeWebOSTV
+from under_control.utils import EventLoopThread
+
+# The request for the i'th call of a scenario, as (method, path, JSON body or None).
+RequestType = Tuple[str, str, Optional[Dict]]
+
+
+def kasa_host(i: int) -> str:
+    return f"127.0.0.{i + 2}"
+
+
+def tv_host(i: int) -> str:
+    return f"127.0.1.{i + 2}"
+
+
+def build_scenarios(aliases: List[str], tv_names: List[str]) -> Dict[str, Callable[[int], RequestType]]:
+    """
+    Build the scenarios to run, each as a function giving the request for its i'th call. Requests are spread
+    round-robin over the devices.
+    """
+    scenarios = {}
+
+    if aliases:
+        def alias(i):
+            return quote(aliases[i % len(aliases)])
+
+        scenarios.update({
+            "kasa_list": lambda i: ("GET", "/kasa", None),
+            "kasa_list_fresh": lambda i: ("GET", "/kasa?fresh=true", None),
+            "kasa_device": lambda i: ("GET", f"/kasa/{alias(i)}", None),
+            "kasa_toggle": lambda i: ("PUT", f"/kasa/{alias(i)}/{'on' if (i // len(aliases)) % 2 else 'off'}", None),
+            "kasa_batch": lambda i: ("POST", "/kasa/batch",
+                                     [{"alias": a, "action": "on" if i % 2 else "off"} for a in aliases]),
+        })
+
+    if tv_names:
+        def tv(i):
+            return tv_names[i % len(tv_names)]
+
+        scenarios.update({
+            "lgtv_list": lambda i: ("GET", "/lgtv", None),
+            "lgtv_command": lambda i: ("POST", f"/lgtv/{tv(i)}/command", {"name": "get_volume"}),
+            "lgtv_key": lambda i: ("POST", f"/lgtv/{tv(i)}/command", {"name": "down" if i % 2 else "up"}),
+            "lgtv_apps": lambda i: ("GET", f"/lgtv/{tv(i)}/apps", None),
+        })
+
+    return scenarios
+
+
+def percentile(values: List[float], p: float) -> float:
+    """
+    The nearest-rank percentile of a sorted list.
+    """
+    return values[max(0, math.ceil(p * len(values)) - 1)]
+
+
+def run_scenario(port: int, request_for: Callable[[int], RequestType], num_requests: int,
+                 concurrency: int) -> Dict:
+    """
+    Send a scenario's requests from a pool of workers, each with its own keep-alive connection.
+
+    :return: The throughput, latency percentiles (in milliseconds) and number of errors - any request that raised or
+             did not get a 2xx response.
+    """
+    local = threading.local()
+
+    def send(i: int) -> Tuple[float, bool]:
+        if not hasattr(local, "conn"):
+            local.conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+
+        method, path, body = request_for(i)
+        headers = {} if body is None else {"Content-Type": "application/json"}
+        started = time.perf_counter()
+        try:
+            local.conn.request(method, path, None if body is None else json.dumps(body), headers)
+            response = local.conn.getresponse()
+            response.read()
+            ok = 200 <= response.status < 300
+        except (OSError, http.client.HTTPException):
+            local.conn.close()
+            del local.conn
+            ok = False
+        return time.perf_counter() - started, ok
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(send, range(num_requests)))
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency * 1000 for latency, _ in results)
+    return {
+        "requests": num_requests,
+        "errors": sum(1 for _, ok in results if not ok),
+        "throughput": num_requests / elapsed,
+        "p50": percentile(latencies, 0.5),
+        "p99": percentile(latencies, 0.99),
+        "max": latencies[-1],
+    }
+
+
+def write_config(file_path: str, args, kasa_devices: List[FakeKasaDevice], tvs: List[str]):
+    adapter_cfgs = {
+        "KasaAdapter": {
+            "enabled": bool(kasa_devices),
+            "optimistic_updates": args.optimistic,
+            "devices": {d.sys_info["alias"]: {"host": d.host, "type": "Bulb" if d.is_bulb else "Plug"}
+                        for d in kasa_devices},
+        },
+        "LGTVAdapter": {
+            "enabled": bool(tvs),
+            "devices": {nm: {"host": tv_host(i), "key": CLIENT_KEY} for i, nm in enumerate(tvs)},
+        },
+    }
+    if args.poll_interval is not None:
+        adapter_cfgs["KasaAdapter"]["poll_interval"] = args.poll_interval
+
+    with open(file_path, "w") as fh:
+        toml.dump({"logging": {"level": args.log_level}, "adapters": adapter_cfgs}, fh)
+
+
+def wait_until_ready(port: int, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+            conn.request("GET", "/health")
+            if conn.getresponse().status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.1)
+    raise TimeoutError(f"Adapters were not ready within {timeout}s")
+
+
+def report(results: Dict[str, Dict]):
+    print(f"{'scenario':<18} {'requests':>8} {'errors':>7} {'req/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for name, r in results.items():
+        print(f"{name:<18} {r['requests']:>8} {r['errors']:>7} {r['throughput']:>9.1f} "
+              f"{r['p50']:>9.2f} {r['p99']:>9.2f} {r['max']:>9.2f}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--kasa-devices", type=int, default=4, help="Number of fake Kasa devices (half are bulbs).")
+    parser.add_argument("--tvs", type=int, default=1, help="Number of fake webOS TVs.")
+    parser.add_argument("--requests", type=int, default=500, help="Number of requests per scenario.")
+    parser.add_argument("--concurrency", type=int, default=8, help="Number of requests in flight at once.")
+    parser.add_argument("--latency", type=float, default=0.01, help="Seconds each fake device takes to respond.")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Up to this many extra seconds of latency.")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Fraction of device requests that fail.")
+    parser.add_argument("--poll-interval", type=float, help="The Kasa adapter's poll interval (0 disables it).")
+    parser.add_argument("--optimistic", action="store_true", help="Enable the Kasa adapter's optimistic updates.")
+    parser.add_argument("--scenarios", nargs="*", help="Only run the named scenarios.")
+    parser.add_argument("--port", type=int, default=7655, help="Port to serve the app on.")
+    parser.add_argument("--log-level", default="WARNING", help="Log level for the app.")
+    parser.add_argument("--json", help="Also write the results to this file, for comparing runs.")
+    return parser.parse_args()
+
+
+def run_benchmarks(args, kasa_devices: List[FakeKasaDevice], tvs: List[str]) -> Dict[str, Dict]:
+    """
+    Serve the app against the running fakes, and drive each scenario against it in turn.
+    """
+    fd, config_path = tempfile.mkstemp(prefix="under_control_benchmark.", suffix=".toml")
+    os.close(fd)
+    write_config(config_path, args, kasa_devices, tvs)
+
+    # Serve the app the same way main.py does
+    from main import app
+    under_control.setup(config_path)
+    under_control.start(app)
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=args.port, log_level="warning"))
+
+    scenarios = build_scenarios([d.sys_info["alias"] for d in kasa_devices], tvs)
+    if args.scenarios:
+        scenarios = {nm: s for nm, s in scenarios.items() if nm in args.scenarios}
+
+    results = {}
+
+    def drive():
+        try:
+            wait_until_ready(args.port)
+            for name, request_for in scenarios.items():
+                results[name] = run_scenario(args.port, request_for, args.requests, args.concurrency)
+        finally:
+            server.should_exit = True
+
+    # The server runs on the main thread, as it would normally, and the load is driven from another
+    driver = threading.Thread(target=drive, name="BenchmarkDriver")
+    driver.start()
+    try:
+        server.run()
+    finally:
+        server.should_exit = True
+        driver.join()
+        os.remove(config_path)
+
+    return results
+
+
+def main():
+    args = parse_args()
+
+    fault_args = {"latency": args.latency, "jitter": args.jitter, "failure_rate": args.failure_rate}
+    kasa_devices = [FakeKasaDevice(kasa_host(i), f"Device {i}", "bulb" if i % 2 else "plug", **fault_args)
+                    for i in range(args.kasa_devices)]
+    tvs = {f"tv{i}": FakeWebOSTV(tv_host(i), **fault_args) for i in range(args.tvs)}
+
+    fakes_loop = EventLoopThread("FakeKasaDevices")
+    fakes_loop.start()
+    try:
+        for device in kasa_devices:
+            fakes_loop.run(device.start())
+        for tv in tvs.values():
+            tv.start()
+
+        results = run_benchmarks(args, kasa_devices, list(tvs))
+    finally:
+        for device in kasa_devices:
+            fakes_loop.run(device.stop())
+        fakes_loop.stop()
+        for tv in tvs.values():
+            tv.stop()
+
+    report(results)
+    if args.json:
+        with open(args.json, "w") as fh:
+            json.dump({"args": vars(args), "results": results}, fh, indent=2)
+
+
+if __name__ == "__main__":
+    main()
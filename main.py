@@ -5,6 +5,7 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
 import under_control
+import under_control.cluster as cluster
 import under_control.config as config
 import under_control.logger as log
 
@@ -22,6 +23,21 @@ def set_cors(app: FastAPI, origins: List[str]):
     )
 
 
+def start(app: FastAPI, workers: int):
+    """
+    Start the adapters, then enable CORS if origins are configured. CORS is added last, so that it wraps the
+    middleware added by the adapters, and their responses (e.g. the 503s for adapters that are still starting up)
+    get its headers too. With multiple workers, they handle CORS themselves.
+
+    :param app: The FastAPI app instance.
+    :param workers: The number of HTTP worker processes.
+    """
+    under_control.start(app)
+    cors_origins = config.get("cors_origins")
+    if cors_origins and workers <= 1:
+        set_cors(app, cors_origins)
+
+
 @app.get("/")
 def read_root() -> Dict:
     return {"Hello": "World"}
@@ -34,8 +50,17 @@ def shutdown_event():
 
 if __name__ == "__main__":
     under_control.setup('config.toml')
-    cors_origins = config.get("cors_origins")
-    if cors_origins:
-        set_cors(app, cors_origins)
-    under_control.start(app)
-    uvicorn.run(app, host="0.0.0.0", port=7654)
+    workers = cluster.num_workers()
+    start(app, workers)
+
+    if workers > 1:
+        # This process holds the devices, and the workers serve the API, forwarding any requests they can't answer
+        # from the shared store to it. They are started as new processes, so are given the app by its import path.
+        try:
+            cluster.start_owner(app)
+            uvicorn.run("under_control.cluster:worker_app", host="0.0.0.0", port=7654, workers=workers)
+        finally:
+            cluster.stop_owner()
+            under_control.stop()
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=7654)
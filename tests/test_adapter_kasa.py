@@ -0,0 +1,63 @@
+import unittest
+from unittest import mock
+
+from fastapi import FastAPI
+from kasa import SmartBulb, SmartPlug
+
+from benchmarks.fake_kasa import FakeKasaDevice
+from under_control.adapters.adapter_kasa import KasaAction, KasaAdapter
+from under_control.utils import EventLoopThread
+
+
+class KasaAdapterTest(unittest.TestCase):
+    """
+    Runs the adapter against fake devices on loopback addresses (see `benchmarks.fake_kasa`).
+    """
+
+    def setUp(self):
+        self.fakes = [FakeKasaDevice("127.0.0.2", "Lamp", "bulb"), FakeKasaDevice("127.0.0.3", "Plug", "plug")]
+        self.fakes_loop = EventLoopThread("FakeKasaDevices")
+        self.fakes_loop.start()
+        for fake in self.fakes:
+            self.fakes_loop.run(fake.start())
+
+        # Only one instance of an adapter is allowed at a time
+        KasaAdapter._instance_count = 0
+        self.adapter = KasaAdapter({'poll_interval': 0, 'update_timeout': 1.0}, FastAPI())
+        self.adapter._devices = {"Lamp": SmartBulb("127.0.0.2"), "Plug": SmartPlug("127.0.0.3")}
+
+    def tearDown(self):
+        self.adapter.shutdown()
+        KasaAdapter._instance_count = 0
+        for fake in self.fakes:
+            self.fakes_loop.run(fake.stop())
+        self.fakes_loop.stop()
+
+    def test_unexpected_error_only_fails_its_device(self):
+        lamp = self.adapter._devices["Lamp"]
+        with mock.patch.object(lamp, "update", side_effect=KeyError("system")):
+            self.adapter.update_devices()
+
+        self.assertIn("Lamp", self.adapter._errors)
+        self.assertNotIn("Plug", self.adapter._errors)
+        self.assertTrue(self.adapter._device_summary("Lamp", lamp)['stale'])
+        self.assertFalse(self.adapter._device_summary("Plug", self.adapter._devices["Plug"])['stale'])
+
+    def test_recovers_after_refresh_times_out(self):
+        self.adapter.cfg['update_timeout'] = 0.3
+        self.fakes[0].latency = 0.6
+        self.adapter.update_devices()
+        self.assertEqual(self.adapter._errors.get("Lamp", None), "Timed out after 0.3s")
+
+        # The late reply to the timed out refresh must not be taken as the reply to the next queries
+        self.fakes[0].latency = 0
+        self.adapter.update_devices()
+        self.assertNotIn("Lamp", self.adapter._errors)
+
+        message = self.adapter._runner.run(self.adapter._perform("Lamp", KasaAction.BRIGHTNESS, [30]))
+        self.assertEqual(message, "Set the brightness of [Lamp] to 30")
+        self.assertEqual(self.adapter._devices["Lamp"].brightness, 30)
+
+
+if __name__ == "__main__":
+    unittest.main()
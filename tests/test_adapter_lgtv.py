@@ -0,0 +1,76 @@
+import time
+import unittest
+from unittest import mock
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from under_control.adapters.adapter_lgtv import LGTVAdapter
+
+
+class LGTVAdapterTest(unittest.TestCase):
+
+    def setUp(self):
+        # Only one instance of an adapter is allowed at a time
+        LGTVAdapter._instance_count = 0
+        self.adapter = None
+
+    def tearDown(self):
+        if self.adapter is not None:
+            self.adapter.shutdown()
+        LGTVAdapter._instance_count = 0
+
+    def start_adapter(self, cfg):
+        self.adapter = LGTVAdapter(cfg, FastAPI())
+        self.adapter.startup()
+        return self.adapter
+
+    def test_starts_with_empty_devices_section(self):
+        adapter = self.start_adapter({'keepalive_interval': 0.01, 'discovery_interval': 0})
+        time.sleep(0.1)
+
+        self.assertEqual(adapter.devices, {})
+        self.assertTrue(adapter._maintenance_thread.is_alive())
+        self.assertEqual(adapter._separate_new_hosts(["192.168.0.2"]), ({}, ["192.168.0.2"]))
+
+    def test_connection_pool_survives_errors(self):
+        with mock.patch.object(LGTVAdapter, "_maintain_pass", side_effect=RuntimeError("boom")) as maintain_pass:
+            adapter = self.start_adapter({'keepalive_interval': 0.01, 'discovery_interval': 0, 'devices': {}})
+            time.sleep(0.1)
+
+            self.assertTrue(adapter._maintenance_thread.is_alive())
+            self.assertGreater(maintain_pass.call_count, 1)
+
+    def test_reconfigure_starts_and_stops_connection_pool(self):
+        cfg = {'keepalive_interval': 0, 'discovery_interval': 0, 'devices': {}}
+        adapter = self.start_adapter(cfg)
+        self.assertIsNone(adapter._maintenance_thread)
+
+        cfg['keepalive_interval'] = 0.01
+        adapter.reconfigure(cfg)
+        thread = adapter._maintenance_thread
+        self.assertTrue(thread.is_alive())
+
+        cfg['keepalive_interval'] = 0
+        adapter.reconfigure(cfg)
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+        self.assertIsNone(adapter._maintenance_thread)
+
+    def test_sequence_delays_are_bounded(self):
+        cfg = {'keepalive_interval': 0, 'discovery_interval': 0, 'devices': {},
+               'macros': {'slow': [{'name': 'up', 'delay': 1e6}]}}
+        app = FastAPI()
+        self.adapter = LGTVAdapter(cfg, app)
+        client = TestClient(app)
+
+        response = client.post("/lgtv/tv/sequence", json=[{"name": "up", "delay": 1e6}])
+        self.assertEqual(response.status_code, 422)
+
+        response = client.post("/lgtv/tv/macros/slow")
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("not valid", response.json()["message"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+import os
+import stat
+import tempfile
+import unittest
+from unittest import mock
+
+import under_control.config as config
+
+
+class ConfigSaveTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.file_path = tempfile.mkstemp(suffix=".toml")
+        with os.fdopen(fd, 'w') as fh:
+            fh.write('title = "Test"\n')
+        os.chmod(self.file_path, 0o644)
+        config.load(self.file_path)
+
+    def tearDown(self):
+        os.remove(self.file_path)
+
+    def test_save_keeps_file_permissions(self):
+        config.set("test.value", 1)
+        config.save(self.file_path)
+
+        self.assertEqual(stat.S_IMODE(os.stat(self.file_path).st_mode), 0o644)
+        with open(self.file_path) as fh:
+            self.assertIn("value = 1", fh.read())
+
+
+class ConfigGetTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.file_path = tempfile.mkstemp(suffix=".toml")
+        with os.fdopen(fd, 'w') as fh:
+            fh.write('[test]\nvalue = 1\n')
+        config.load(self.file_path)
+
+    def tearDown(self):
+        os.remove(self.file_path)
+
+    def test_change_while_resolving_is_not_masked(self):
+        resolve = config._resolve
+
+        def resolve_then_change(item_path):
+            # Another thread changes the value after it has been resolved, but before it is memoised
+            value = resolve(item_path)
+            config.set("test.value", 2)
+            return value
+
+        with mock.patch.object(config, "_resolve", side_effect=resolve_then_change):
+            self.assertEqual(config.get("test.value"), 1)
+        self.assertEqual(config.get("test.value"), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,42 @@
+import io
+import json
+import unittest
+from unittest import mock
+
+import under_control.logger as log
+
+
+class LoggerTest(unittest.TestCase):
+
+    def log_exception(self, cfg) -> str:
+        out = io.StringIO()
+        with mock.patch("sys.stdout", out):
+            log.setup_logger(cfg)
+            try:
+                try:
+                    raise ValueError("bad reply")
+                except ValueError:
+                    log.get_logger("TestAdapter").exception("Refresh of %s failed", "Lamp")
+            finally:
+                log.stop_logger()
+        return out.getvalue()
+
+    def test_json_exception_is_kept_separate(self):
+        for queued in (False, True):
+            with self.subTest(queued=queued):
+                output = self.log_exception({'level': 'INFO', 'format': 'json', 'queued': queued})
+                entry = json.loads(output.strip())
+
+                self.assertEqual(entry["message"], "Refresh of Lamp failed")
+                self.assertEqual(entry["logger"], "TestAdapter")
+                self.assertIn("ValueError: bad reply", entry["exception"])
+
+    def test_queued_text_includes_traceback(self):
+        output = self.log_exception({'level': 'INFO', 'queued': True})
+
+        self.assertIn("TestAdapter ERROR Refresh of Lamp failed", output)
+        self.assertIn("ValueError: bad reply", output)
+
+
+if __name__ == "__main__":
+    unittest.main()
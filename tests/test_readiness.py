@@ -0,0 +1,69 @@
+import os
+import tempfile
+import threading
+import unittest
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import main
+import under_control.config as config
+from under_control import adapters
+
+
+class SlowAdapter(adapters.Adapter):
+    """
+    An adapter that doesn't finish starting up until it is released.
+    """
+
+    def __init__(self, cfg, app: FastAPI):
+        super().__init__(cfg, app)
+        self.released = threading.Event()
+
+    def startup(self):
+        self.released.wait(10)
+
+    def shutdown(self):
+        self.released.set()
+
+    def _register_endpoints(self, app: FastAPI):
+        @app.get("/slow")
+        def slow_devices():
+            return {}
+
+
+class ReadinessCorsTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.file_path = tempfile.mkstemp(suffix=".toml")
+        with os.fdopen(fd, 'w') as fh:
+            fh.write('cors_origins = ["http://dashboard.local"]\n\n[adapters.SlowAdapter]\n')
+        config.load(self.file_path)
+
+        SlowAdapter._instance_count = 0
+        adapters._registered_adapters.clear()
+        adapters._registered_adapters["SlowAdapter"] = SlowAdapter
+
+    def tearDown(self):
+        adapters.shutdown()
+        for state in (adapters._registered_adapters, adapters._created_adapters, adapters._adapter_routes,
+                      adapters._adapter_status):
+            state.clear()
+        os.remove(self.file_path)
+
+    def test_not_ready_response_has_cors_headers(self):
+        app = FastAPI()
+        main.start(app, workers=1)
+        client = TestClient(app)
+
+        response = client.get("/slow", headers={"Origin": "http://dashboard.local"})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers.get("access-control-allow-origin"), "http://dashboard.local")
+
+        response = client.get("/health", headers={"Origin": "http://dashboard.local"})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers.get("access-control-allow-origin"), "http://dashboard.local")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,303 @@
+import asyncio
+import threading
+import time
+import unittest
+from typing import Any, Awaitable, Callable, List
+
+from under_control.utils import AsyncCommandQueue, AsyncSingleFlight, CommandQueue, SingleFlight
+
+
+class Caller(threading.Thread):
+    """
+    Calls a function on its own thread, keeping the result or exception.
+    """
+
+    def __init__(self, fn: Callable[[], Any]):
+        super().__init__(daemon=True)
+        self.fn = fn
+        self.result = self.error = None
+        self.start()
+
+    def run(self):
+        try:
+            self.result = self.fn()
+        except Exception as e:
+            self.error = e
+
+
+def wait_until(condition: Callable[[], bool], timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError("Condition was not met")
+        time.sleep(0.001)
+
+
+class CommandQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = CommandQueue("TestCommandQueue")
+        self.sent: List[Any] = []
+        self.release = threading.Event()
+
+    def send(self, value: Any) -> Callable[[], Any]:
+        def fn():
+            self.sent.append(value)
+            return value
+        return fn
+
+    def block(self) -> Caller:
+        """
+        Start a command that holds up the queue until released, so that the next commands wait behind it.
+        """
+        started = threading.Event()
+
+        def fn():
+            started.set()
+            self.release.wait(5)
+            return "blocked"
+
+        caller = Caller(lambda: self.queue.run(fn))
+        started.wait(5)
+        return caller
+
+    def queue_waiting(self, fn: Callable[[], Any], kind=None) -> Caller:
+        """
+        Queue a command from another thread, returning once it is waiting.
+        """
+        caller = Caller(lambda: self.queue.run(fn, kind))
+        wait_until(lambda: any(command.fn is fn for command in self.queue._pending))
+        return caller
+
+    def test_runs_commands_in_order(self):
+        blocker = self.block()
+        callers = [self.queue_waiting(self.send(i)) for i in range(5)]
+        self.release.set()
+        for caller in [blocker] + callers:
+            caller.join(5)
+
+        self.assertEqual(self.sent, [0, 1, 2, 3, 4])
+        self.assertEqual([c.result for c in callers], [0, 1, 2, 3, 4])
+
+    def test_latest_command_of_a_kind_wins(self):
+        blocker = self.block()
+        volumes = [self.queue_waiting(self.send(("volume", i)), "volume") for i in range(3)]
+        mute = self.queue_waiting(self.send(("mute", True)), "mute")
+        volumes.append(self.queue_waiting(self.send(("volume", 3)), "volume"))
+        self.release.set()
+        for caller in [blocker, mute] + volumes:
+            caller.join(5)
+
+        # The waiting volume command moved behind the mute when it was replaced
+        self.assertEqual(self.sent, [("mute", True), ("volume", 3)])
+        self.assertEqual([c.result for c in volumes], [("volume", 3)] * 4)
+        self.assertEqual(mute.result, ("mute", True))
+
+    def test_spaces_out_commands(self):
+        self.queue.min_interval = 0.05
+        started = []
+        callers = [Caller(lambda: self.queue.run(lambda: started.append(time.monotonic()))) for _ in range(3)]
+        for caller in callers:
+            caller.join(5)
+
+        self.assertEqual(len(started), 3)
+        for earlier, later in zip(started, started[1:]):
+            self.assertGreaterEqual(later - earlier, 0.045)
+
+    def test_error_is_raised_to_every_waiting_caller(self):
+        def fail():
+            raise ValueError("failed")
+
+        blocker = self.block()
+        callers = [self.queue_waiting(self.send(1), "volume"), self.queue_waiting(fail, "volume")]
+        self.release.set()
+        for caller in [blocker] + callers:
+            caller.join(5)
+
+        self.assertEqual(self.sent, [])
+        for caller in callers:
+            self.assertIsInstance(caller.error, ValueError)
+
+        # The queue carries on after the error
+        self.assertEqual(self.queue.run(self.send(2)), 2)
+
+
+class AsyncCommandQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sent: List[Any] = []
+
+    def send(self, value: Any) -> Callable[[], Awaitable]:
+        async def fn():
+            self.sent.append(value)
+            return value
+        return fn
+
+    @staticmethod
+    async def queue_waiting(queue: AsyncCommandQueue, fn: Callable[[], Awaitable], kind=None) -> asyncio.Future:
+        """
+        Queue a command, returning once it is waiting, with the future for its caller's result.
+        """
+        caller = asyncio.ensure_future(queue.run(fn, kind))
+        while not any(command.fn is fn for command in queue._pending):
+            await asyncio.sleep(0)
+        return caller
+
+    @staticmethod
+    async def block(queue: AsyncCommandQueue, release: asyncio.Event) -> asyncio.Future:
+        started = asyncio.Event()
+
+        async def fn():
+            started.set()
+            await release.wait()
+
+        caller = asyncio.ensure_future(queue.run(fn))
+        await started.wait()
+        return caller
+
+    def test_latest_command_of_a_kind_wins(self):
+        async def scenario():
+            queue, release = AsyncCommandQueue(), asyncio.Event()
+            blocker = await self.block(queue, release)
+            first = await self.queue_waiting(queue, self.send("first"))
+            volumes = [await self.queue_waiting(queue, self.send(("volume", i)), "volume") for i in range(3)]
+            last = await self.queue_waiting(queue, self.send("last"))
+            release.set()
+            await blocker
+            return await asyncio.gather(first, *volumes, last)
+
+        results = asyncio.run(scenario())
+        self.assertEqual(self.sent, ["first", ("volume", 2), "last"])
+        self.assertEqual(results, ["first"] + [("volume", 2)] * 3 + ["last"])
+
+    def test_spaces_out_commands(self):
+        started = []
+
+        async def command():
+            started.append(time.monotonic())
+
+        async def scenario():
+            queue = AsyncCommandQueue(min_interval=0.05)
+            await asyncio.gather(*[queue.run(command) for _ in range(3)])
+
+        asyncio.run(scenario())
+        self.assertEqual(len(started), 3)
+        for earlier, later in zip(started, started[1:]):
+            self.assertGreaterEqual(later - earlier, 0.045)
+
+    def test_error_is_raised_to_every_waiting_caller(self):
+        async def fail():
+            raise ValueError("failed")
+
+        async def scenario():
+            queue, release = AsyncCommandQueue(), asyncio.Event()
+            blocker = await self.block(queue, release)
+            callers = [await self.queue_waiting(queue, self.send(1), "volume"),
+                       await self.queue_waiting(queue, fail, "volume")]
+            release.set()
+            await blocker
+            results = await asyncio.gather(*callers, return_exceptions=True)
+            # The queue carries on after the error
+            return results, await queue.run(self.send(2))
+
+        results, after = asyncio.run(scenario())
+        self.assertTrue(all(isinstance(r, ValueError) for r in results))
+        self.assertEqual(self.sent, [2])
+        self.assertEqual(after, 2)
+
+class SingleFlightTest(unittest.TestCase):
+
+    def test_coalesces_concurrent_calls(self):
+        flight, release, calls = SingleFlight(), threading.Event(), []
+
+        def read():
+            calls.append(1)
+            release.wait(5)
+            return "state"
+
+        leader = Caller(lambda: flight.run("devices", read))
+        wait_until(lambda: calls)
+        followers = [Caller(lambda: flight.run("devices", read)) for _ in range(5)]
+        wait_until(lambda: all(f.is_alive() for f in followers))
+        time.sleep(0.05)
+        release.set()
+        for caller in [leader] + followers:
+            caller.join(5)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual([c.result for c in [leader] + followers], ["state"] * 6)
+
+        # Once it has finished, the next call runs the operation again
+        self.assertEqual(flight.run("devices", read), "state")
+        self.assertEqual(len(calls), 2)
+
+    def test_error_is_raised_to_every_caller(self):
+        flight, release = SingleFlight(), threading.Event()
+
+        def fail():
+            release.wait(5)
+            raise ValueError("failed")
+
+        callers = [Caller(lambda: flight.run("devices", fail)) for _ in range(3)]
+        time.sleep(0.05)
+        release.set()
+        for caller in callers:
+            caller.join(5)
+
+        self.assertTrue(all(isinstance(c.error, ValueError) for c in callers))
+
+    def test_different_keys_run_separately(self):
+        flight = SingleFlight()
+        self.assertEqual(flight.run("a", lambda: 1), 1)
+        self.assertEqual(flight.run("b", lambda: 2), 2)
+
+
+class AsyncSingleFlightTest(unittest.TestCase):
+
+    def test_coalesces_concurrent_calls(self):
+        calls = []
+
+        async def read():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return "state"
+
+        async def scenario():
+            flight = AsyncSingleFlight()
+            results = await asyncio.gather(*[flight.run("devices", read) for _ in range(5)])
+            return results, await flight.run("devices", read)
+
+        results, after = asyncio.run(scenario())
+        self.assertEqual(results, ["state"] * 5)
+        self.assertEqual(after, "state")
+        self.assertEqual(len(calls), 2)
+
+    def test_error_is_raised_to_every_caller(self):
+        async def fail():
+            await asyncio.sleep(0.01)
+            raise ValueError("failed")
+
+        async def scenario():
+            flight = AsyncSingleFlight()
+            return await asyncio.gather(*[flight.run("devices", fail) for _ in range(3)], return_exceptions=True)
+
+        self.assertTrue(all(isinstance(r, ValueError) for r in asyncio.run(scenario())))
+
+    def test_cancelled_caller_does_not_cancel_the_others(self):
+        async def read():
+            await asyncio.sleep(0.02)
+            return "state"
+
+        async def scenario():
+            flight = AsyncSingleFlight()
+            first = asyncio.ensure_future(flight.run("devices", read))
+            second = asyncio.ensure_future(flight.run("devices", read))
+            await asyncio.sleep(0)
+            first.cancel()
+            return await second
+
+        self.assertEqual(asyncio.run(scenario()), "state")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -4,7 +4,9 @@ from fastapi import FastAPI
 
 from under_control import adapters
 import under_control.config as config
+import under_control.events as events
 import under_control.logger as log
+import under_control.metrics as metrics
 
 
 def setup(config_path: AnyStr):
@@ -14,9 +16,14 @@ def setup(config_path: AnyStr):
     """
     config.load(config_path)
 
-    logger.setup_logger(config.get('logging.level'))
+    log.setup_logger(config.get('logging'))
 
-    adapters.find_adapters()
+    try:
+        lazy = config.get('adapters.lazy_load')
+    except config.ConfigException:
+        lazy = False
+
+    adapters.find_adapters(lazy)
     log.logger.info("Setup complete")
 
 
@@ -24,15 +31,31 @@ def start(app: FastAPI):
     """
     Run through all the adapter plugins found during setup and instantiate them.
 
-    Then trigger startup on all plugins.
+    Then trigger startup on all plugins, and start watching the config file for changes if enabled. Request
+    metrics are served on `/metrics`, and device state changes are streamed on `/events`.
     :param app: The FastIO app, used to register plugin endpoints.
     """
     adapters.create(app)
+    metrics.setup(app)
+    events.setup(app)
     adapters.startup()
 
+    try:
+        watch_interval = config.get('config.watch_interval')
+    except config.ConfigException:
+        watch_interval = 0
+
+    if watch_interval > 0:
+        log.logger.info(f"Watching config for changes every {watch_interval}s")
+        config.watch(watch_interval)
+
 
 def stop():
     """
-    Run through all the adapter plugins found during setup and shut them down.
+    Run through all the adapter plugins found during setup and shut them down, then write out any config changes
+    and log records that are still pending.
     """
+    config.stop_watching()
     adapters.shutdown()
+    config.flush()
+    log.stop_logger()
@@ -1,19 +1,35 @@
 import importlib
 import inspect
 import pathlib
+import threading
+import time
 from abc import ABC, abstractmethod
-from typing import Type, Dict
+from enum import auto
+from typing import Type, Dict, List, Optional
 
-from fastapi import FastAPI
+from fastapi import FastAPI, status
+from fastapi.responses import JSONResponse
+from starlette.routing import BaseRoute, Match
 
 import under_control.config as config
 import under_control.logger as log
+from under_control.utils import AutoName
+
+# Default number of seconds an adapter's startup may take before it is reported as timed out.
+DEFAULT_STARTUP_TIMEOUT: float = 60.0
 
 
 class AdapterException(Exception):
     pass
 
 
+class AdapterState(AutoName):
+    STARTING: str = auto()
+    READY: str = auto()
+    FAILED: str = auto()
+    TIMED_OUT: str = auto()
+
+
 class Adapter(ABC):
     """
     Abstract base class for the Adapter plugin classes.
@@ -32,6 +48,7 @@ class Adapter(ABC):
 
     def __init__(self, cfg: Dict, app: FastAPI):
         self.cfg = cfg
+        log.set_level(type(self).__name__, self.log_level)
         self._register_endpoints(app)
 
         if type(self)._instance_count > 0:
@@ -55,6 +72,37 @@ class Adapter(ABC):
         """
         pass
 
+    def reconfigure(self, cfg: Optional[Dict]):
+        """
+        This will get fired when the adapter's config section changes on a config reload. Reloads update the
+        section in place, so any settings that are read from `self.cfg` when used take effect straight away.
+        Override this to apply any other settings.
+        :param cfg: The new config section, or None if it has been removed.
+        """
+        if cfg is None:
+            cfg = {}
+        if cfg is not self.cfg:
+            self.cfg = cfg
+        log.set_level(type(self).__name__, self.log_level)
+        log.logger.info("Config for %s has changed.", type(self).__name__)
+
+    @property
+    def log_level(self) -> Optional[str]:
+        """
+        The level for the adapter's logger (`log.get_logger` with the adapter's class name), from
+        `adapters.<class name>.log_level` in the config. None uses the level from `logging.level`.
+        """
+        return self.cfg.get('log_level', None)
+
+    @property
+    def state_is_cached(self) -> bool:
+        """
+        Whether the device state the adapter publishes (see `events.publish`) is kept up to date in the background,
+        so that its device listings can be answered from the published state. In multi-worker mode the workers then
+        serve them from the shared store, rather than forwarding them to the adapter. False unless overridden.
+        """
+        return False
+
     @abstractmethod
     def _register_endpoints(self, app: FastAPI):
         """
@@ -71,8 +119,31 @@ _registered_adapters: Dict[str, Type] = {}
 # Instantiated instances of adapter plugins.
 _created_adapters: Dict[str, Adapter] = {}
 
+# The routes registered by each adapter, indexed by adapter name. Used to reject requests to adapters that aren't
+# ready yet.
+_adapter_routes: Dict[str, List[BaseRoute]] = {}
+
+# The startup state of each adapter, indexed by adapter name, along with any error and how long startup took.
+_adapter_status: Dict[str, Dict] = {}
+
+# The number of seconds it took to import the module of each registered adapter class, indexed by class name.
+_import_times: Dict[str, float] = {}
 
-def find_adapters():
+
+def _enabled_sections() -> Dict[str, Dict]:
+    """
+    Get the config sections under `adapters` for the adapters that are enabled, indexed by adapter class name. An
+    adapter is enabled if it has a section, unless that section sets `enabled = false`.
+    """
+    try:
+        sections = config.get("adapters")
+    except config.ConfigException:
+        return {}
+
+    return {nm: cfg for nm, cfg in sections.items() if isinstance(cfg, dict) and cfg.get("enabled", True)}
+
+
+def find_adapters(lazy: bool = False):
     """
     Search the adapters directory for all adapter plugin classes.
 
@@ -80,6 +151,12 @@ def find_adapters():
     'Adapter`.
 
     All detected classes will be registered in the module-level dictionary above, indexed by name.
+
+    In lazy mode, the config is read first, and only the modules for the enabled adapters are imported, which
+    saves loading the third party libraries of unused adapters. This relies on the adapter for a given module
+    being named after it - `adapter_kasa.py` must hold the `KasaAdapter` class.
+
+    :param lazy: Only import and register the adapters that are enabled in the config.
     """
 
     def adapter_predicate(obj: Type):
@@ -94,13 +171,28 @@ def find_adapters():
         return inspect.isclass(obj) and obj.__name__ != "Adapter" and obj.__name__.endswith("Adapter")
 
     adapters_path = pathlib.Path(__file__).parent
-    files = [f"{__name__}.{f.stem}" for f in adapters_path.glob("adapter_*.py")]
+
+    if lazy:
+        enabled = _enabled_sections()
+        stems = [f"adapter_{nm.replace('Adapter', '').lower()}" for nm in enabled]
+        for nm, stem in zip(enabled, stems):
+            if not (adapters_path / f"{stem}.py").exists():
+                log.logger.warning(f"Could not find module {stem} for adapter {nm}.")
+        files = [f"{__name__}.{stem}" for stem in stems if (adapters_path / f"{stem}.py").exists()]
+    else:
+        files = [f"{__name__}.{f.stem}" for f in adapters_path.glob("adapter_*.py")]
 
     for f in files:
+        started = time.perf_counter()
         module = importlib.import_module(f)
+        import_time = round(time.perf_counter() - started, 3)
+
         for nm, cls in inspect.getmembers(module, adapter_predicate):
+            if lazy and nm not in enabled:
+                continue
             _registered_adapters[nm] = cls
-            log.logger.info(f"Registered adapter {nm}.")
+            _import_times[nm] = import_time
+            log.logger.info(f"Registered adapter {nm}, imported in {import_time}s.")
 
 
 def create(app: FastAPI):
@@ -121,18 +213,111 @@ def create(app: FastAPI):
             log.logger.warn(err)
             cfg = {}
 
+        if not cfg.get("enabled", True):
+            log.logger.info(f"Adapter {cls_name} is disabled.")
+            continue
+
         adapter_name = cls_name.replace("Adapter", "").lower()
+        num_routes = len(app.router.routes)
+        started = time.perf_counter()
         _created_adapters[adapter_name] = AdapterCls(cfg, app)
+        create_time = round(time.perf_counter() - started, 3)
+        log.logger.info(f"Created adapter {cls_name} in {create_time}s.")
+
+        _adapter_routes[adapter_name] = app.router.routes[num_routes:]
+        _adapter_status[adapter_name] = {
+            "state": AdapterState.STARTING,
+            "error": None,
+            "import_time": _import_times.get(cls_name, None),
+            "create_time": create_time,
+            "startup_time": None
+        }
+        config.on_change(f"adapters.{cls_name}", _created_adapters[adapter_name].reconfigure)
     log.logger.info("All adapters loaded")
     log.logger.debug(f"Adapters: {', '.join(a for a in _created_adapters)}")
 
+    app.add_middleware(ReadinessMiddleware)
+
+    @app.get("/health")
+    def health() -> JSONResponse:
+        all_ready = all(s["state"] == AdapterState.READY for s in _adapter_status.values())
+        adapter_states = {n: {**s, "state": s["state"].value} for n, s in _adapter_status.items()}
+        return JSONResponse(
+            {"ready": all_ready, "adapters": adapter_states},
+            status_code=status.HTTP_200_OK if all_ready else status.HTTP_503_SERVICE_UNAVAILABLE
+        )
+
+
+class ReadinessMiddleware:
+    """
+    ASGI middleware that answers requests to the routes of any adapter that hasn't finished starting up with a 503,
+    rather than letting them reach an adapter that isn't ready to handle them.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            for name, adapter_status in _adapter_status.items():
+                if adapter_status["state"] == AdapterState.READY:
+                    continue
+                if any(route.matches(scope)[0] == Match.FULL for route in _adapter_routes[name]):
+                    message = f"Adapter {name} is not ready [{adapter_status['state'].value}]"
+                    response = JSONResponse({"message": message}, status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+                    await response(scope, receive, send)
+                    return
+
+        await self.app(scope, receive, send)
+
+
+def _start_adapter(adapter_name: str, adapter: Adapter):
+    """
+    Run an adapter's startup method and record the outcome. If it runs for longer than the adapter's startup timeout
+    (`startup_timeout` in its config), it is reported as timed out - it is left running, and will be marked ready if
+    it does eventually finish.
+
+    :param adapter_name: The name of the adapter.
+    :param adapter: The adapter instance.
+    """
+    adapter_status = _adapter_status[adapter_name]
+    timeout = adapter.cfg.get("startup_timeout", DEFAULT_STARTUP_TIMEOUT)
+
+    def timed_out():
+        if adapter_status["state"] == AdapterState.STARTING:
+            adapter_status["state"] = AdapterState.TIMED_OUT
+            log.logger.error(f"Adapter {adapter_name} did not start up within {timeout}s")
+
+    timer = threading.Timer(timeout, timed_out)
+    timer.daemon = True
+    timer.start()
+
+    started = time.monotonic()
+    try:
+        adapter.startup()
+    except Exception as e:
+        adapter_status["error"] = str(e)
+        adapter_status["state"] = AdapterState.FAILED
+        log.logger.exception(f"Adapter {adapter_name} failed to start up")
+    else:
+        adapter_status["state"] = AdapterState.READY
+        log.logger.info(f"Adapter {adapter_name} started up")
+    finally:
+        timer.cancel()
+        adapter_status["startup_time"] = round(time.monotonic() - started, 3)
+
 
 def startup():
     """
-    Run through all adapter instances and call their startup methods
+    Run through all adapter instances and call their startup methods.
+
+    Each adapter starts up on its own thread, and this returns straight away, so the server can start accepting
+    requests while adapters are still starting. Requests to an adapter's routes get a 503 until it is ready -
+    the state of each adapter is reported on `/health`.
     """
-    for a in _created_adapters.values():
-        a.startup()
+    for adapter_name, a in _created_adapters.items():
+        threading.Thread(target=_start_adapter, args=(adapter_name, a),
+                         name=f"{type(a).__name__}Startup", daemon=True).start()
 
 
 def shutdown():
@@ -143,6 +328,13 @@ def shutdown():
         a.shutdown()
 
 
+def names() -> List[str]:
+    """
+    Get the names of all the adapter instances.
+    """
+    return list(_created_adapters)
+
+
 def get(adapter_name: str) -> Adapter:
     """
     Get an adapter, based on its name.
@@ -1,11 +1,170 @@
 import asyncio
-from typing import Dict
+import concurrent.futures
+import time
+from enum import auto
+from typing import Any, Collection, Dict, List, Optional, Type
 
-from fastapi import FastAPI, Response, status, Path
-from kasa import Discover
+from fastapi import FastAPI, Header, Query, Response, status, Path
+from pydantic import BaseModel, ValidationError
+from kasa import (
+    DeviceType,
+    Discover,
+    SmartBulb,
+    SmartDevice,
+    SmartDeviceException,
+    SmartDimmer,
+    SmartLightStrip,
+    SmartPlug,
+    SmartStrip
+)
 
+import under_control.config as config
+import under_control.events as events
 import under_control.logger as log
+import under_control.metrics as metrics
 from under_control import adapters
+from under_control.utils import AsyncCommandQueue, AsyncSingleFlight, AutoName, CompactJSONResponse, EventLoopThread
+
+logger = log.get_logger("KasaAdapter")
+
+# Default number of seconds to wait for any single device to respond during a state refresh.
+DEFAULT_UPDATE_TIMEOUT: float = 5.0
+
+# Default number of seconds between background refreshes of the device state cache.
+DEFAULT_POLL_INTERVAL: float = 10.0
+
+# Default minimum number of seconds between the commands sent to each device. Zero sends them as fast as the device
+# responds.
+DEFAULT_COMMAND_INTERVAL: float = 0.0
+
+# Default number of seconds after the last optimistic write to a device before its state is re-read to reconcile.
+DEFAULT_RECONCILE_DELAY: float = 2.0
+
+# The device classes used to reconnect to known devices, indexed by the device type name stored in the config.
+DEVICE_CLASSES: Dict[str, Type[SmartDevice]] = {
+    DeviceType.Plug.name: SmartPlug,
+    DeviceType.Bulb.name: SmartBulb,
+    DeviceType.Strip.name: SmartStrip,
+    DeviceType.Dimmer.name: SmartDimmer,
+    DeviceType.LightStrip.name: SmartLightStrip,
+}
+
+
+class KasaException(Exception):
+    pass
+
+
+class KasaAction(AutoName):
+    """
+    The actions that can be performed on a device. The auto() value will be the lower-case of the enum item's name
+    (see utils.AutoName), matching the single-device endpoint paths.
+    """
+    ON: str = auto()
+    OFF: str = auto()
+    COLOUR: str = auto()
+    COLOUR_TEMP: str = auto()
+    BRIGHTNESS: str = auto()
+
+
+# The number of arguments each action expects, e.g. [h, s, v] for a colour change.
+ACTION_ARG_COUNTS: Dict[KasaAction, int] = {
+    KasaAction.ON: 0,
+    KasaAction.OFF: 0,
+    KasaAction.COLOUR: 3,
+    KasaAction.COLOUR_TEMP: 1,
+    KasaAction.BRIGHTNESS: 1,
+}
+
+# The setting each action changes. An action replaces any other for the same setting that is still waiting to be sent
+# to the device, as only the latest value matters.
+ACTION_SETTINGS: Dict[KasaAction, str] = {
+    KasaAction.ON: "power",
+    KasaAction.OFF: "power",
+    KasaAction.COLOUR: "colour",
+    KasaAction.COLOUR_TEMP: "colour",
+    KasaAction.BRIGHTNESS: "brightness",
+}
+
+
+class OperationModel(BaseModel):
+    alias: str
+    action: KasaAction
+    args: List[int] = []
+
+
+class KasaSnapshot:
+    """
+    A compact copy of the state of a device, as served by the API. It is built once each time the device's state
+    changes, so that reads only have to encode it. Settings the device doesn't support are None, as is everything
+    but the alias and host of a device that has never been read.
+    """
+    __slots__ = ('alias', 'host', 'type', 'model', 'is_on', 'brightness', 'hsv', 'colour_temp', 'emeter', 'children',
+                 '_dict')
+
+    # The fields that can be selected with `?fields=`
+    FIELDS = __slots__[:-1]
+
+    def __init__(self, alias: str, dev: SmartDevice):
+        self.alias = alias
+        self.host = dev.host
+        self.type = self.model = self.is_on = self.brightness = self.hsv = self.colour_temp = None
+        self.emeter = self.children = None
+
+        if dev._last_update is not None:
+            self.type = dev.device_type.name
+            self.model = dev.model
+            self.is_on = dev.is_on
+            if dev.is_dimmable:
+                self.brightness = dev.brightness
+            if dev.is_color:
+                self.hsv = list(dev.hsv)
+            if dev.is_variable_color_temp:
+                self.colour_temp = dev.color_temp
+            if dev.has_emeter:
+                self.emeter = self._emeter(dev)
+            if dev.is_strip:
+                self.children = [KasaSnapshot(child.alias, child).to_dict() for child in dev.children]
+
+        self._dict = {nm: getattr(self, nm) for nm in self.FIELDS}
+
+    @staticmethod
+    def _emeter(dev: SmartDevice) -> Optional[Dict]:
+        try:
+            reading = dev.emeter_realtime
+        except (SmartDeviceException, KeyError):
+            return None
+        emeter = {'power': reading.power, 'voltage': reading.voltage, 'current': reading.current,
+                  'total': reading.total}
+        # Devices that don't answer the emeter request give no readings at all
+        return emeter if any(v is not None for v in emeter.values()) else None
+
+    def to_dict(self, fields: Optional[Collection[str]] = None) -> Dict:
+        """
+        Get the snapshot as a dict, ready to be encoded as JSON. The full dict is shared, so must not be modified.
+
+        :param fields: The names of the fields to include, or None for all of them.
+        :return: The fields and their values.
+        """
+        if fields is None:
+            return self._dict
+        return {nm: self._dict[nm] for nm in fields}
+
+
+def parse_fields(fields: Optional[str]) -> Optional[List[str]]:
+    """
+    Parse a `?fields=` selection of snapshot fields.
+
+    :param fields: A comma-separated list of field names, or None to select every field.
+    :return: The field names, or None to select every field.
+    """
+    if fields is None:
+        return None
+    names = [nm.strip() for nm in fields.split(',') if nm.strip()]
+    unknown = [nm for nm in names if nm not in KasaSnapshot.FIELDS]
+    if unknown:
+        raise KasaException(f"Unknown field(s) [{', '.join(unknown)}]. "
+                            f"Valid fields are: {', '.join(KasaSnapshot.FIELDS)}")
+    return names
 
 
 class KasaAdapter(adapters.Adapter):
@@ -13,12 +172,130 @@ class KasaAdapter(adapters.Adapter):
     def __init__(self, cfg, app: FastAPI):
         super().__init__(cfg, app)
         self._devices = {}
+        # Devices that failed their most recent refresh, mapped to the reason. Their state is stale.
+        self._errors: Dict[str, str] = {}
+        # Monotonic time at which each device's state was last successfully read from the device.
+        self._last_updated: Dict[str, float] = {}
+        self._poller: Optional[concurrent.futures.Future] = None
+        self._discovery: Optional[concurrent.futures.Future] = None
+        # Pending deferred refreshes of optimistically updated devices, indexed by alias. Only used on the loop.
+        self._reconcile_handles: Dict[str, asyncio.TimerHandle] = {}
+        # Reads of the device state that are in flight, indexed by alias, or None for a refresh of every device, so
+        # that concurrent reads share them. Only used on the loop.
+        self._refreshes = AsyncSingleFlight()
+        # The queue of commands waiting to be sent to each device, indexed by alias. Only used on the loop.
+        self._command_queues: Dict[str, AsyncCommandQueue] = {}
+        # The snapshot of each device's state as of its last change, indexed by alias.
+        self._snapshots: Dict[str, KasaSnapshot] = {}
+
+        # All python-kasa coroutines run on this one loop, so device connections survive between requests.
+        self._runner = EventLoopThread("KasaAdapterLoop")
+        self._runner.start()
+
+    @property
+    def update_timeout(self) -> float:
+        """
+        The per-device timeout for a state refresh, from `adapters.KasaAdapter.update_timeout` in the config.
+        """
+        return self.cfg.get('update_timeout', DEFAULT_UPDATE_TIMEOUT)
+
+    @property
+    def poll_interval(self) -> float:
+        """
+        The number of seconds between background refreshes, from `adapters.KasaAdapter.poll_interval` in the
+        config. Zero or less disables the poller, in which case every read goes to the devices.
+        """
+        return self.cfg.get('poll_interval', DEFAULT_POLL_INTERVAL)
+
+    @property
+    def optimistic_updates(self) -> bool:
+        """
+        Whether setters should apply the known result of a command to the cached state, instead of re-reading the
+        device straight away. From `adapters.KasaAdapter.optimistic_updates` in the config.
+        """
+        return self.cfg.get('optimistic_updates', False)
+
+    @property
+    def command_interval(self) -> float:
+        """
+        The minimum number of seconds between the commands sent to each device, from
+        `adapters.KasaAdapter.command_interval` in the config. Can be overridden for a device in its section under
+        `devices`.
+        """
+        return self.cfg.get('command_interval', DEFAULT_COMMAND_INTERVAL)
+
+    @property
+    def reconcile_delay(self) -> float:
+        """
+        The number of seconds after an optimistic write before the device is re-read, from
+        `adapters.KasaAdapter.reconcile_delay` in the config. Further writes in this window push the re-read back.
+        """
+        return self.cfg.get('reconcile_delay', DEFAULT_RECONCILE_DELAY)
+
+    @property
+    def is_polling(self) -> bool:
+        return self._poller is not None and not self._poller.done()
+
+    @property
+    def state_is_cached(self) -> bool:
+        return self.is_polling
+
+    @property
+    def known_devices(self) -> Dict[str, Dict]:
+        """
+        The devices found by previous discoveries, persisted in the config, indexed by alias. Each entry holds
+        the device's `host` and device `type`.
+        """
+        return self.cfg.get('devices', {})
 
     def startup(self):
-        self.discover_devices()
+        """
+        If devices were found on a previous run, connect to them directly and run discovery in the background
+        to pick up new or moved devices. Otherwise, block on discovery so the API starts with a device list.
+        """
+        if self.known_devices:
+            self._runner.run(self._connect_known_devices())
+            self._discovery = self._runner.spawn(self._discover_devices())
+        else:
+            self.discover_devices()
+
+        if self.poll_interval > 0:
+            self._poller = self._runner.spawn(self._poll_devices())
+
+    def reconfigure(self, cfg: Optional[Dict]):
+        """
+        Start or stop the background poller if the poll interval has been enabled or disabled.
+        """
+        super().reconfigure(cfg)
+        if self.poll_interval > 0 and not self.is_polling:
+            self._poller = self._runner.spawn(self._poll_devices())
+        elif self.poll_interval <= 0 and self.is_polling:
+            self._poller.cancel()
 
     def shutdown(self):
-        pass
+        for task in (self._poller, self._discovery):
+            if task is not None:
+                task.cancel()
+        self._runner.run(self._close_connections())
+        self._runner.stop()
+
+    async def _close_connections(self):
+        """
+        Close the open connection to each device.
+        """
+        await asyncio.gather(*[dev.protocol.close() for dev in self._devices.values()])
+
+    async def _poll_devices(self):
+        """
+        Keep the cached device state fresh by refreshing all devices every poll interval, until cancelled.
+        """
+        logger.info("Polling devices every %ss", self.poll_interval)
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                await self._update_devices()
+            except Exception as e:
+                logger.error("Background refresh failed: %s", e)
 
     def get_devices(self):
         return self._devices
@@ -29,25 +306,358 @@ class KasaAdapter(adapters.Adapter):
         usage state, etc.), so we need to provide a way to update the status of the devices.
 
         This should be cheaper than discovery, because we already know the IPs.
+
+        All devices are refreshed concurrently, each with its own timeout, so the whole refresh takes roughly as
+        long as the slowest device (capped by the timeout). A device that fails or times out keeps its last known
+        state and is recorded in the error dict, rather than failing the whole batch.
+        """
+        self._runner.run(self._update_devices())
+
+    async def _update_devices(self):
+        """
+        Refresh every known device at the same time, or wait for the refresh that is already in flight. Devices that
+        are already being read on their own share that read. See `update_devices`.
+        """
+
+        async def update_all():
+            devices = list(self._devices.items())
+            await asyncio.gather(*[self._refresh_device(alias, dev) for alias, dev in devices])
+
+        await self._refreshes.run(None, update_all)
+
+    async def _refresh_device(self, alias: str, dev: SmartDevice):
+        """
+        Read a device's state, or wait for the read that is already in flight. Only for reads of the current state -
+        after a change, use `_update_device`, so the device is read again after the change was made.
+
+        :param alias: The alias the device is indexed by.
+        :param dev: The device to refresh.
+        """
+        await self._refreshes.run(alias, lambda: self._update_device(alias, dev))
+
+    async def _update_device(self, alias: str, dev: SmartDevice):
+        """
+        Refresh a single device, bounded by the update timeout. Records or clears the device's error accordingly - any
+        error is recorded, so a refresh of every device is not failed by one of them.
+
+        :param alias: The alias the device is indexed by.
+        :param dev: The device to refresh.
+        """
+        logger.debug("Updating device %s: %s", alias, dev)
+        try:
+            with metrics.device_call("kasa", "update", alias):
+                await asyncio.wait_for(dev.update(), self.update_timeout)
+        except asyncio.TimeoutError:
+            self._errors[alias] = f"Timed out after {self.update_timeout}s"
+            # The request may have been sent without its reply being read, and python-kasa doesn't close the
+            # connection when cancelled. The late reply would be read as the reply to the next query, so reconnect.
+            await dev.protocol.close()
+        except SmartDeviceException as e:
+            self._errors[alias] = str(e)
+        except Exception as e:
+            # e.g. a malformed reply. It only marks this device as stale, rather than failing a refresh of them all.
+            self._errors[alias] = f"Unexpected error: {e!r}"
+        else:
+            self._errors.pop(alias, None)
+            self._last_updated[alias] = time.monotonic()
+            logger.debug("Updated device %s: %s", alias, dev)
+            self._publish(alias, dev)
+            return
+
+        logger.warning("Failed to update device %s: %s", alias, self._errors[alias])
+        self._publish(alias, dev)
+
+    def _snapshot(self, alias: str, dev: SmartDevice) -> KasaSnapshot:
+        """
+        Get the snapshot of a device's state, building it if the device has just been added and not yet published.
+        """
+        snapshot = self._snapshots.get(alias, None)
+        if snapshot is None:
+            snapshot = self._snapshots[alias] = KasaSnapshot(alias, dev)
+        return snapshot
+
+    def _device_summary(self, alias: str, dev: SmartDevice, fields: Optional[List[str]] = None) -> Dict:
+        """
+        Build the API representation of a device, flagging whether its state is stale and how old it is.
+
+        :param alias: The alias the device is indexed by.
+        :param dev: The device.
+        :param fields: The snapshot fields to include, or None for all of them.
+        :return: The device's snapshot along with its refresh status.
+        """
+        last_updated = self._last_updated.get(alias, None)
+        return {
+            'device': self._snapshot(alias, dev).to_dict(fields),
+            'stale': alias in self._errors,
+            'error': self._errors.get(alias, None),
+            'age': None if last_updated is None else round(time.monotonic() - last_updated, 3)
+        }
+
+    def _publish(self, alias: str, dev: SmartDevice):
+        """
+        Take a new snapshot of a device's state, and publish it to the event stream. The age is left out, as it
+        changes all the time.
+
+        :param alias: The alias the device is indexed by.
+        :param dev: The device.
         """
-        for dev in self._devices.values():
-            log.logger.info(f"KasaAdapter: Updating device {dev.alias}: {dev}")
-            asyncio.run(dev.update())
-            log.logger.info(f"KasaAdapter: Updated device {dev.alias}: {dev}")
+        self._snapshots[alias] = KasaSnapshot(alias, dev)
+        summary = self._device_summary(alias, dev)
+        del summary['age']
+        events.publish("kasa", alias, summary)
 
     def discover_devices(self):
         """
         Call the discovery method of the Kasa API. This is quite slow and shouldn't be done regularly.
         For all detected devices, we update their state and store them in the device list, indexed by
         their alias.
+
+        Devices that are already known are kept, so their connections are reused, unless they have moved to a new
+        host. Known devices that were not found are also kept - they will be reported as stale if unreachable.
+        The resulting alias -> host/type map is persisted to the config, for a fast startup next time.
+        """
+        self._runner.run(self._discover_devices())
+
+    async def _discover_devices(self):
+        """
+        Run discovery, then refresh the new devices concurrently. See `discover_devices`.
         """
-        self._devices.clear()
-        log.logger.info("KasaAdapter: Discovering devices...")
-        devices = asyncio.run(Discover.discover())
+        logger.info("Discovering devices...")
+        with metrics.discovery_duration.time(adapter="kasa"):
+            devices = await Discover.discover()
+
+        found = {}
         for dev in devices.values():
-            asyncio.run(dev.update())
-            self._devices[dev.alias] = dev
-            log.logger.info(f"KasaAdapter: Found device {dev.alias}: {dev}")
+            known = self._devices.get(dev.alias, None)
+            if known is None or known.host != dev.host:
+                found[dev.alias] = dev
+                logger.info("Found device %s at %s", dev.alias, dev.host)
+                if known is not None:
+                    await known.protocol.close()
+
+        if not found:
+            logger.info("No new devices found")
+            return
+
+        self._devices.update(found)
+        await asyncio.gather(*[self._refresh_device(alias, dev) for alias, dev in found.items()])
+        self._save_known_devices()
+
+    async def _connect_known_devices(self):
+        """
+        Create the devices persisted from a previous discovery and refresh them concurrently. This only talks to
+        the known hosts directly, which is much faster than a broadcast discovery.
+        """
+        for alias, known in self.known_devices.items():
+            DeviceCls = DEVICE_CLASSES.get(known.get('type', None), SmartDevice)
+            self._devices[alias] = DeviceCls(known['host'])
+
+        logger.info("Connecting to %d known devices...", len(self._devices))
+        await self._update_devices()
+
+    def _save_known_devices(self):
+        """
+        Persist the alias -> host/type map for the current devices to the config file. Any other settings in a
+        device's section, such as its command interval, are kept.
+        """
+        known = self.known_devices
+        self.cfg['devices'] = {
+            alias: {**known.get(alias, {}), 'host': dev.host, 'type': dev.device_type.name}
+            for alias, dev in self._devices.items()
+        }
+        config.set("adapters.KasaAdapter", self.cfg)
+        config.save_later()
+
+    @staticmethod
+    def _merge_light_state(sys_info: Dict, changes: Dict):
+        """
+        Merge changes into a bulb's cached light state. The bulb reports its settings at the top level when it is
+        on, but under `dft_on_state` when it is off, so the settings are moved between the two as needed.
+
+        :param sys_info: The bulb's cached system info, which is updated in place.
+        :param changes: The light state changes, e.g. {'on_off': 1, 'brightness': 50}.
+        """
+        current = sys_info['light_state']
+        if current['on_off']:
+            settings = {k: v for k, v in current.items() if k != 'on_off'}
+        else:
+            settings = dict(current.get('dft_on_state', {}))
+
+        settings.update({k: v for k, v in changes.items() if k not in ('on_off', 'dft_on_state')})
+        settings.update(changes.get('dft_on_state', {}))
+
+        is_on = changes.get('on_off', current['on_off'])
+        if is_on:
+            sys_info['light_state'] = {**settings, 'on_off': is_on}
+        else:
+            sys_info['light_state'] = {'on_off': is_on, 'dft_on_state': settings}
+
+    def _apply_result(self, dev: SmartDevice, action: KasaAction, args: List[int], result: Any) -> bool:
+        """
+        Apply the known outcome of a successful command to the device's cached state, without re-reading it.
+
+        :param dev: The device the command was sent to.
+        :param action: The action that was performed.
+        :param args: The arguments for the action.
+        :param result: The response to the command from the device. Bulbs respond with their new light state.
+        :return: True if the cached state was updated, False if the outcome is not known for this device type.
+        """
+        sys_info = dev.sys_info
+
+        if dev.is_bulb:
+            changes = {
+                KasaAction.ON: lambda: {'on_off': 1},
+                KasaAction.OFF: lambda: {'on_off': 0},
+                KasaAction.COLOUR: lambda: {'on_off': 1, 'hue': args[0], 'saturation': args[1],
+                                            'brightness': args[2], 'color_temp': 0},
+                KasaAction.COLOUR_TEMP: lambda: {'on_off': 1, 'color_temp': args[0]},
+                KasaAction.BRIGHTNESS: lambda: {'on_off': 1, 'brightness': args[0]},
+            }[action]()
+            if isinstance(result, dict):
+                changes.update(result)
+            self._merge_light_state(sys_info, changes)
+            return True
+
+        # Strips report the state of each socket separately, so leave those to a refresh
+        if dev.is_strip:
+            return False
+
+        if action in (KasaAction.ON, KasaAction.OFF):
+            sys_info['relay_state'] = int(action == KasaAction.ON)
+            return True
+
+        if action == KasaAction.BRIGHTNESS and dev.is_dimmer:
+            # Dimmers coerce a brightness of 0 to 1
+            sys_info['brightness'] = max(args[0], 1)
+            return True
+
+        return False
+
+    def _schedule_reconcile(self, alias: str, dev: SmartDevice):
+        """
+        Re-read a device's state after the reconcile delay, replacing any re-read that is already pending, so that
+        a burst of writes leads to a single refresh. Must be called on the adapter loop.
+
+        :param alias: The alias the device is indexed by.
+        :param dev: The device to refresh.
+        """
+        handle = self._reconcile_handles.pop(alias, None)
+        if handle is not None:
+            handle.cancel()
+
+        def reconcile():
+            self._reconcile_handles.pop(alias, None)
+            asyncio.ensure_future(self._update_device(alias, dev))
+
+        self._reconcile_handles[alias] = asyncio.get_running_loop().call_later(self.reconcile_delay, reconcile)
+
+    def _command_queue(self, alias: str) -> AsyncCommandQueue:
+        """
+        Get the queue of commands for a device, applying its command interval. Must be called on the adapter loop.
+        """
+        queue = self._command_queues.get(alias, None)
+        if queue is None:
+            queue = self._command_queues[alias] = AsyncCommandQueue()
+        queue.min_interval = self.known_devices.get(alias, {}).get('command_interval', self.command_interval)
+        return queue
+
+    async def _perform(self, alias: str, action: KasaAction, args: List[int]) -> str:
+        """
+        Check that an action can be applied to a device, then queue it to be sent. Must be run on the adapter loop.
+
+        The commands for each device are sent one at a time, spaced out by the command interval. An action that is
+        still waiting when another for the same setting is queued (e.g. a brightness slider being dragged) is
+        replaced by it, and both return the result of the latest.
+
+        After each command, the device is re-read to refresh its state. In optimistic mode, the known outcome of the
+        command is applied to the cached state instead, saving a round-trip, and the device is re-read a little
+        later.
+
+        :param alias: The alias of the device to act on.
+        :param action: The action to perform.
+        :param args: The arguments for the action, e.g. the [h, s, v] values for a colour change.
+        :return: A message describing the change.
+        """
+        dev = self._get_device(alias)
+        if dev is None:
+            raise KasaException(f"Could not find device [{alias}]")
+
+        expected_args = ACTION_ARG_COUNTS[action]
+        if len(args) != expected_args:
+            raise KasaException(f"Action [{action.value}] expects {expected_args} argument(s), got {len(args)}")
+
+        return await self._command_queue(alias).run(lambda: self._send(alias, dev, action, args),
+                                                    ACTION_SETTINGS[action])
+
+    async def _send(self, alias: str, dev: SmartDevice, action: KasaAction, args: List[int]) -> str:
+        """
+        Send an action to a device, then refresh its state. See `_perform`.
+        """
+        try:
+            if action == KasaAction.ON:
+                command, message = dev.turn_on(), f"Turned on [{alias}]"
+            elif action == KasaAction.OFF:
+                command, message = dev.turn_off(), f"Turned off [{alias}]"
+            elif action == KasaAction.COLOUR:
+                if not dev.is_color:
+                    raise KasaException(f"Cannot set the colour of [{alias}]")
+                command = dev.set_hsv(*args)
+                message = f"Set the colour of [{alias}] to {','.join(str(a) for a in args)}"
+            elif action == KasaAction.COLOUR_TEMP:
+                if not dev.is_variable_color_temp:
+                    raise KasaException(f"Cannot set the colour temperature of [{alias}]")
+                command = dev.set_color_temp(*args)
+                message = f"Set the colour temperature of [{alias}] to {args[0]}K"
+            elif action == KasaAction.BRIGHTNESS:
+                if not dev.is_dimmable:
+                    raise KasaException(f"Cannot set the brightness of [{alias}]")
+                command = dev.set_brightness(*args)
+                message = f"Set the brightness of [{alias}] to {args[0]}"
+            else:
+                raise NotImplementedError(f"Couldn't find handler for action: {action}")
+
+            with metrics.device_call("kasa", action.value, alias):
+                result = await command
+            if self.optimistic_updates and self._apply_result(dev, action, args, result):
+                self._publish(alias, dev)
+                self._schedule_reconcile(alias, dev)
+            else:
+                await self._update_device(alias, dev)
+        except (SmartDeviceException, ValueError) as e:
+            raise KasaException(f"Failed to apply [{action.value}] to [{alias}]: {e}")
+
+        return message
+
+    async def _perform_batch(self, operations: List[OperationModel]) -> List[Dict]:
+        """
+        Perform a list of operations concurrently. Must be run on the adapter loop. A failed operation does not
+        affect the others.
+
+        :param operations: The operations to perform.
+        :return: A result for each operation, in the same order.
+        """
+
+        async def perform_one(op: OperationModel) -> Dict:
+            try:
+                message = await self._perform(op.alias, op.action, op.args)
+                success = True
+            except KasaException as e:
+                message = str(e)
+                success = False
+            return {"alias": op.alias, "action": op.action, "success": success, "message": message}
+
+        return list(await asyncio.gather(*[perform_one(op) for op in operations]))
+
+    async def _action_response(self, response: Response, alias: str, action: KasaAction, args: List[int]) -> Dict:
+        """
+        Perform a single action on the adapter loop and build the endpoint response for it.
+        """
+        try:
+            message = await self._runner.submit(self._perform(alias, action, args))
+        except KasaException as e:
+            response.status_code = status.HTTP_400_BAD_REQUEST
+            return {"message": str(e)}
+        return {"message": message}
 
     def _get_device(self, alias: str):
         """
@@ -61,100 +671,117 @@ class KasaAdapter(adapters.Adapter):
     def _register_endpoints(self, app: FastAPI):
 
         @app.get("/kasa")
-        def kasa_devices() -> Dict:
-            self.update_devices()
-            return self.get_devices()
+        async def kasa_devices(response: Response, fresh: bool = False,
+                               wait_for_change: float = Query(0, ge=0, le=events.MAX_WAIT_FOR_CHANGE),
+                               fields: Optional[str] = None,
+                               if_none_match: Optional[str] = Header(None)) -> Dict:
+            """
+            List every device, with its state and refresh status. `fields` limits each device's state to a
+            comma-separated list of fields, e.g. `?fields=alias,is_on`.
+            """
+            try:
+                field_names = parse_fields(fields)
+            except KasaException as e:
+                response.status_code = status.HTTP_400_BAD_REQUEST
+                return {"message": str(e)}
+
+            await events.wait_for_change("kasa", None, if_none_match, wait_for_change)
+            if fresh or not self.is_polling:
+                await self._runner.submit(self._update_devices())
+
+            not_modified = events.not_modified(response, if_none_match, "kasa")
+            if not_modified is not None:
+                return not_modified
+
+            # Discovery may add devices from the adapter loop, so take a copy before iterating
+            devices = list(self.get_devices().items())
+            summaries = {alias: self._device_summary(alias, dev, field_names) for alias, dev in devices}
+            return CompactJSONResponse(summaries, headers={"ETag": response.headers["ETag"]})
+
+        @app.post("/kasa/batch")
+        async def kasa_batch(operations: List[OperationModel]) -> Dict:
+            return {"results": await self._runner.submit(self._perform_batch(operations))}
+
+        @app.post("/kasa/scenes/{name}")
+        async def kasa_scene(name: str, response: Response) -> Dict:
+            scenes = self.cfg.get('scenes', {})
+            if name not in scenes:
+                response.status_code = status.HTTP_400_BAD_REQUEST
+                return {"message": f"Scene named {name} has not been configured."}
+
+            try:
+                operations = [OperationModel(**op) for op in scenes[name]]
+            except ValidationError as e:
+                response.status_code = status.HTTP_400_BAD_REQUEST
+                return {"message": f"Scene named {name} is not valid: {e}"}
+
+            return {"results": await self._runner.submit(self._perform_batch(operations))}
 
         @app.get("/kasa/{alias}")
-        def kasa_single_device(alias: str) -> Dict:
+        async def kasa_single_device(alias: str, response: Response, fresh: bool = False,
+                                     wait_for_change: float = Query(0, ge=0, le=events.MAX_WAIT_FOR_CHANGE),
+                                     fields: Optional[str] = None,
+                                     if_none_match: Optional[str] = Header(None)) -> Dict:
+            """
+            Get a device's state and refresh status. `fields` limits the state to a comma-separated list of fields,
+            e.g. `?fields=alias,is_on`.
+            """
+            try:
+                field_names = parse_fields(fields)
+            except KasaException as e:
+                response.status_code = status.HTTP_400_BAD_REQUEST
+                return {"message": str(e)}
+
             devices = self.get_devices()
             if not alias in devices:
                 return {}
 
+            await events.wait_for_change("kasa", alias, if_none_match, wait_for_change)
             dev = devices[alias]
-            asyncio.run(dev.update())
-            return dev
+            if fresh or not self.is_polling:
+                await self._runner.submit(self._refresh_device(alias, dev))
+
+            not_modified = events.not_modified(response, if_none_match, "kasa", alias)
+            if not_modified is not None:
+                return not_modified
+            return CompactJSONResponse(self._device_summary(alias, dev, field_names),
+                                       headers={"ETag": response.headers["ETag"]})
 
         @app.put("/kasa/{alias}/on")
-        def device_on(alias: str, response: Response) -> Dict:
-            dev = self._get_device(alias)
-            if dev is None:
-                response.status_code = status.HTTP_400_BAD_REQUEST
-                return {"message": f"Could not find device [{alias}]"}
-            asyncio.run(dev.turn_on())
-            asyncio.run(dev.update())
-            return {"message": f"Turned on [{alias}]"}
+        async def device_on(alias: str, response: Response) -> Dict:
+            return await self._action_response(response, alias, KasaAction.ON, [])
 
         @app.put("/kasa/{alias}/off")
-        def device_off(alias: str, response: Response) -> Dict:
-            dev = self._get_device(alias)
-            if dev is None:
-                response.status_code = status.HTTP_400_BAD_REQUEST
-                return {"message": f"Could not find device [{alias}]"}
-            asyncio.run(dev.turn_off())
-            asyncio.run(dev.update())
-            return {"message": f"Turned off [{alias}]"}
+        async def device_off(alias: str, response: Response) -> Dict:
+            return await self._action_response(response, alias, KasaAction.OFF, [])
 
         @app.put("/kasa/{alias}/colour/{colour_spec}")
-        def set_bulb_colour(response: Response,
-                            alias: str = Path(..., title="Device Alias"),
-                            colour_spec: str = Path(...,
-                                                    title="Comma-separated HSV tuple",
-                                                    description="Hue: 0...360, S: 0...100, V: 0...100.",
-                                                    regex=r'^\d{1,3},\d{1,3},\d{1,3}$'),
-                            ) -> Dict:
-            dev = self._get_device(alias)
-            if dev is None:
-                response.status_code = status.HTTP_400_BAD_REQUEST
-                return {"message": f"Could not find device [{alias}]"}
-
-            if not dev.is_color:
-                response.status_code = status.HTTP_400_BAD_REQUEST
-                return {"message": f"Cannot set the colour of [{alias}]"}
-
-            h, s, v = [int(i) for i in colour_spec.split(',')]
-            asyncio.run(dev.set_hsv(h, s, v))
-            asyncio.run(dev.update())
-            return {"message": f"Set the colour of [{alias}] to {colour_spec}"}
+        async def set_bulb_colour(response: Response,
+                                  alias: str = Path(..., title="Device Alias"),
+                                  colour_spec: str = Path(...,
+                                                          title="Comma-separated HSV tuple",
+                                                          description="Hue: 0...360, S: 0...100, V: 0...100.",
+                                                          regex=r'^\d{1,3},\d{1,3},\d{1,3}$'),
+                                  ) -> Dict:
+            hsv = [int(i) for i in colour_spec.split(',')]
+            return await self._action_response(response, alias, KasaAction.COLOUR, hsv)
 
         @app.put("/kasa/{alias}/colour_temp/{colour_temp}")
-        def set_bulb_colour_temp(response: Response,
-                                 alias: str = Path(..., title="Device Alias"),
-                                 colour_temp: int = Path(...,
-                                                         title="Colour temperature in Kelvin",
-                                                         description="An integer between 2500 and 9000",
-                                                         ge=2500, le=9000),
-                                 ) -> Dict:
-            dev = self._get_device(alias)
-            if dev is None:
-                response.status_code = status.HTTP_400_BAD_REQUEST
-                return {"message": f"Could not find device [{alias}]"}
-
-            if not dev.is_variable_color_temp:
-                response.status_code = status.HTTP_400_BAD_REQUEST
-                return {"message": f"Cannot set the colour temperature of [{alias}]"}
-
-            asyncio.run(dev.set_color_temp(colour_temp))
-            asyncio.run(dev.update())
-            return {"message": f"Set the colour temperature of [{alias}] to {colour_temp}K"}
+        async def set_bulb_colour_temp(response: Response,
+                                       alias: str = Path(..., title="Device Alias"),
+                                       colour_temp: int = Path(...,
+                                                               title="Colour temperature in Kelvin",
+                                                               description="An integer between 2500 and 9000",
+                                                               ge=2500, le=9000),
+                                       ) -> Dict:
+            return await self._action_response(response, alias, KasaAction.COLOUR_TEMP, [colour_temp])
 
         @app.put("/kasa/{alias}/brightness/{brightness}")
-        def set_bulb_brightness(response: Response,
-                                alias: str = Path(..., title="Device Alias"),
-                                brightness: int = Path(...,
-                                                       title="Colour brightness",
-                                                       description="An integer between 0 and 100",
-                                                       ge=0, le=100),
-                                ) -> Dict:
-            dev = self._get_device(alias)
-            if dev is None:
-                response.status_code = status.HTTP_400_BAD_REQUEST
-                return {"message": f"Could not find device [{alias}]"}
-
-            if not dev.is_dimmable:
-                response.status_code = status.HTTP_400_BAD_REQUEST
-                return {"message": f"Cannot set the brightness of ¬[{alias}]"}
-
-            asyncio.run(dev.set_brightness(brightness))
-            asyncio.run(dev.update())
-            return {"message": f"Set the brightness of [{alias}] to {brightness}"}
+        async def set_bulb_brightness(response: Response,
+                                      alias: str = Path(..., title="Device Alias"),
+                                      brightness: int = Path(...,
+                                                             title="Colour brightness",
+                                                             description="An integer between 0 and 100",
+                                                             ge=0, le=100),
+                                      ) -> Dict:
+            return await self._action_response(response, alias, KasaAction.BRIGHTNESS, [brightness])
@@ -1,10 +1,12 @@
-import re
-import subprocess
+import socket
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from enum import auto
-from typing import Dict, List, Tuple, Union, Optional
+from typing import Callable, Dict, Iterable, List, Tuple, Union, Optional
 
-from fastapi import FastAPI, Response, status
-from pydantic import BaseModel
+from fastapi import FastAPI, Header, Query, Response, status
+from pydantic import BaseModel, Field, ValidationError
 from pywebostv.connection import WebOSClient
 from pywebostv.controls import (
     SystemControl,
@@ -12,14 +14,47 @@ from pywebostv.controls import (
     ApplicationControl,
     InputControl
 )
+from pywebostv.model import Application
+from starlette.concurrency import run_in_threadpool
 
 import under_control.config as config
+import under_control.events as events
 import under_control.logger as log
+import under_control.metrics as metrics
 from under_control import adapters
-from under_control.utils import AutoName
+from under_control.utils import AutoName, CommandQueue, SingleFlight
 
 HostType = str
 
+logger = log.get_logger("LGTVAdapter")
+
+# The port the webOS websocket API listens on. A TV that accepts connections here is online.
+WEBOS_PORT: int = 3000
+
+# Default number of seconds to wait for a TV to accept a connection when checking whether it is online.
+DEFAULT_PROBE_TIMEOUT: float = 1.0
+
+# Default number of seconds the online status of the TVs is cached for.
+DEFAULT_PROBE_TTL: float = 5.0
+
+# Default number of seconds a TV's pointer input socket is kept open after the last key press.
+DEFAULT_INPUT_IDLE_TIMEOUT: float = 30.0
+
+# Default number of seconds between keepalive checks of the connections to the paired TVs.
+DEFAULT_KEEPALIVE_INTERVAL: float = 30.0
+
+# Default upper limit, in seconds, of the backoff between attempts to reconnect to a TV.
+DEFAULT_RECONNECT_MAX_BACKOFF: float = 300.0
+
+# Default number of seconds between background discoveries. Zero disables periodic discovery.
+DEFAULT_DISCOVERY_INTERVAL: float = 0.0
+
+# Default minimum number of seconds between the commands sent to each TV. Zero sends them as fast as the TV responds.
+DEFAULT_COMMAND_INTERVAL: float = 0.0
+
+# The longest delay, in seconds, before a step of a sequence. The delays hold up every other command to the TV.
+MAX_STEP_DELAY: float = 10.0
+
 
 class LGTVException(Exception):
     pass
@@ -76,20 +111,197 @@ class InputCommand(AutoName):
 
 GenericCommand = Union[InputCommand, MediaCommand, AppCommand, SystemCommand]
 
+# The setting changed by each command that sets an absolute value. Such a command replaces any other for the same
+# setting that is still waiting to be sent to the TV, as only the latest value matters. Other commands, such as
+# key presses and relative volume changes, are all sent.
+COMMAND_SETTINGS: Dict[GenericCommand, str] = {
+    MediaCommand.SET_VOLUME: "volume",
+    MediaCommand.MUTE: "mute",
+}
+
+
+class AppIndex:
+    """
+    Lookup index over a TV's application catalogue, so that apps can be resolved locally from a user-supplied name.
+    """
+
+    def __init__(self, apps: List[Application]):
+        self.apps: List[Application] = apps
+
+        self._by_id: Dict[str, Application] = {}
+        self._by_title: Dict[str, Application] = {}
+        self._by_prefix: Dict[str, Application] = {}
+        for app in apps:
+            self._by_id[app["id"]] = app
+            title = self.normalise(app["title"])
+            self._by_title.setdefault(title, app)
+            for i in range(1, len(title)):
+                self._by_prefix.setdefault(title[:i], app)
+
+    @staticmethod
+    def normalise(name: str) -> str:
+        """
+        Normalise an app name for matching - lower-case, with anything that isn't a letter or number removed.
+        """
+        return "".join(c for c in name.lower() if c.isalnum())
+
+    def find(self, query: str) -> Optional[Application]:
+        """
+        Find an app by, in order of preference, its exact id, its title, the start of its title, or any part of its
+        title. Titles are compared after normalisation, so 'prime video' will match 'Prime Video'.
+
+        :param query: The app id or (part of) the app title.
+        :return: The matching app, or None if no app matches.
+        """
+        if query in self._by_id:
+            return self._by_id[query]
+
+        name = self.normalise(query)
+        if not name:
+            return None
+
+        app = self._by_title.get(name, None) or self._by_prefix.get(name, None)
+        if app is not None:
+            return app
+
+        return next((a for a in self.apps if name in self.normalise(a["title"])), None)
+
 
 class LGTVCommander:
     """
     Wrapper for the WebOsClient to handle command funnelling.
     """
 
-    def __init__(self, client):
+    def __init__(self, client, client_key: str = None, input_idle_timeout: float = DEFAULT_INPUT_IDLE_TIMEOUT,
+                 name: str = None):
         self.client: WebOSClient = client
+        # The name of the device, used to label metrics.
+        self.name = name if name is not None else client.host
+        # The pairing key the TV registered this client with.
+        self.client_key = client_key
+        self.input_idle_timeout = input_idle_timeout
 
         self._system: SystemControl = SystemControl(client)
         self._media: MediaControl = MediaControl(client)
         self._app: ApplicationControl = ApplicationControl(client)
         self._inp: InputControl = InputControl(client)
 
+        # The TV's app catalogue, fetched when first needed.
+        self._app_index: Optional[AppIndex] = None
+
+        # The pointer input socket is held open between key presses, and closed by this timer once idle.
+        self._input_lock = threading.Lock()
+        self._input_timer: Optional[threading.Timer] = None
+
+    def _input_connected(self) -> bool:
+        mouse_ws = getattr(self._inp, 'mouse_ws', None)
+        return mouse_ws is not None and not mouse_ws.terminated
+
+    def _acquire_input(self):
+        """
+        Take exclusive use of the pointer input socket, connecting it if it isn't already open.
+        Must be paired with `_release_input`.
+        """
+        self._input_lock.acquire()
+        try:
+            if self._input_timer is not None:
+                self._input_timer.cancel()
+            if not self._input_connected():
+                self._inp.connect_input()
+        except OSError as e:
+            self._input_lock.release()
+            raise LGTVException(f"Could not open the pointer input socket: {e}")
+        except Exception:
+            self._input_lock.release()
+            raise
+
+    def _release_input(self):
+        """
+        Give up use of the pointer input socket, leaving it open until it has been idle for the idle timeout.
+        """
+        self._input_timer = threading.Timer(self.input_idle_timeout, self.close_input)
+        self._input_timer.daemon = True
+        self._input_timer.start()
+        self._input_lock.release()
+
+    def close_input(self):
+        """
+        Close the pointer input socket, if it is open.
+        """
+        with self._input_lock:
+            if self._input_timer is not None:
+                self._input_timer.cancel()
+                self._input_timer = None
+            if self._input_connected():
+                self._inp.disconnect_input()
+
+    def close(self):
+        """
+        Close the pointer input socket and the connection to the TV.
+        """
+        self.close_input()
+        self.client.close_connection()
+
+    @property
+    def is_alive(self) -> bool:
+        """
+        Whether the websocket to the TV is still open. A socket the TV has closed is only noticed once the close
+        has been received - use `ping` to check that the TV is still responding.
+        """
+        return not self.client.terminated
+
+    def ping(self, timeout: float) -> bool:
+        """
+        Send a cheap request to the TV and wait for the response, to keep the connection alive and check that it
+        still works.
+
+        :param timeout: Seconds to wait for the response.
+        :return: True if the TV responded in time, False otherwise.
+        """
+        try:
+            self._app.get_current(timeout=timeout)
+            return True
+        except Exception:
+            return False
+
+    def subscribe_state(self, callback: Callable[[Dict], None]):
+        """
+        Subscribe to changes in the TV's volume and foreground app. The TV sends the current values straight away,
+        then again whenever they change.
+
+        :param callback: Function called with the changed values, e.g. {'app': 'netflix'}, from the client thread.
+        """
+        def on_volume(success, payload):
+            if success:
+                # Newer TVs nest the volume settings
+                volume_status = payload.get('volumeStatus', payload)
+                callback({'volume': volume_status.get('volume', None), 'muted': volume_status.get('muted', None)})
+
+        def on_app(success, app_id):
+            if success:
+                callback({'app': app_id})
+
+        self._media.subscribe_get_volume(on_volume)
+        self._app.subscribe_get_current(on_app)
+
+    def get_apps(self, refresh: bool = False) -> AppIndex:
+        """
+        Get the index of the apps installed on the TV. The catalogue is only fetched from the TV the first time, or
+        when a refresh is requested.
+
+        :param refresh: Fetch the catalogue from the TV even if it has been cached.
+        :return: The app index.
+        """
+        if refresh or self._app_index is None:
+            self._app_index = AppIndex(self._app.list_apps())
+        return self._app_index
+
+    def invalidate_apps(self):
+        """
+        Drop the cached app catalogue, so that it is fetched again when next needed.
+        """
+        self._app_index = None
+
     def send_command(self, command: GenericCommand, message: str = None) -> Union[str, Dict]:
         """
         For a given command object, this will choose the Control class and instance, then send the command
@@ -104,10 +316,60 @@ class LGTVCommander:
         """
         is_input: bool = isinstance(command, InputCommand)
 
+        if is_input:
+            self._acquire_input()
+
+        try:
+            with metrics.device_call("lgtv", command.value, self.name):
+                return self._dispatch(command, message)
+        except OSError as e:
+            # The controls raise an IOError when the TV answers with an error
+            raise LGTVException(f"Command [{command.value}] failed: {e}")
+        finally:
+            if is_input:
+                self._release_input()
+
+    def send_sequence(self, steps: Iterable[Tuple[GenericCommand, Optional[str], float]]) -> List[Union[str, Dict]]:
+        """
+        Send a sequence of commands in order, e.g. to navigate a menu. If the sequence contains any input commands,
+        the pointer input socket is held for the whole sequence, so no other key presses can be interleaved.
+
+        :param steps: The (command, message, delay) for each step, where the delay is the number of seconds to wait
+                      before sending the command.
+        :return: The response from the host for each step.
+        """
+        steps = list(steps)
+        has_input = any(isinstance(command, InputCommand) for command, _, _ in steps)
+
+        if has_input:
+            self._acquire_input()
+
+        responses = []
+        try:
+            for i, (command, message, delay) in enumerate(steps):
+                if delay > 0:
+                    time.sleep(delay)
+                try:
+                    with metrics.device_call("lgtv", command.value, self.name):
+                        responses.append(self._dispatch(command, message))
+                except (LGTVException, OSError) as e:
+                    raise LGTVException(f"Step {i} [{command.value}] failed: {e}")
+        finally:
+            if has_input:
+                self._release_input()
+
+        return responses
+
+    def _dispatch(self, command: GenericCommand, message: str = None) -> Union[str, Dict]:
+        """
+        Send a single command. The caller must have acquired the pointer input socket for input commands.
+        See `send_command`.
+        """
+        is_input: bool = isinstance(command, InputCommand)
+
         if is_input:
             HandlerCls = InputControl
             handler = self._inp
-            self._inp.connect_input()
         elif isinstance(command, MediaCommand):
             HandlerCls = MediaControl
             handler = self._media
@@ -120,6 +382,9 @@ class LGTVCommander:
         else:
             raise NotImplementedError(f"Couldn't find command handler for command: {command}")
 
+        if command == AppCommand.LIST_APPS:
+            return self.get_apps().apps
+
         # Command names in the API are dynamically registered using the __getattr__ private function
         cmd_func = HandlerCls.__getattr__(handler, command.name.lower())
 
@@ -129,17 +394,16 @@ class LGTVCommander:
             if command == MediaCommand.SET_VOLUME:
                 message = int(message)
             elif command == AppCommand.LAUNCH:
-                # The host expects an application object - we'll query the host for it here
-                apps = self._app.list_apps()
-                message = [x for x in apps if message in x["title"].lower()][0]
+                # The host expects an application object - we'll look it up in the cached catalogue here
+                app = self.get_apps().find(message)
+                if app is None:
+                    raise LGTVException(f"Could not find an app matching [{message}].")
+                message = app
             elif command == MediaCommand.MUTE:
                 message = message == "True"
 
             response = cmd_func(message)
 
-        if is_input:
-            self._inp.disconnect_input()
-
         return response
 
 
@@ -148,6 +412,11 @@ class CommandRequestModel(BaseModel):
     message: Optional[str] = None
 
 
+class SequenceStepModel(CommandRequestModel):
+    # Seconds to wait before sending this command.
+    delay: float = Field(0.0, ge=0, le=MAX_STEP_DELAY)
+
+
 class LGTVAdapter(adapters.Adapter):
 
     def __init__(self, cfg, app: FastAPI):
@@ -155,13 +424,118 @@ class LGTVAdapter(adapters.Adapter):
         self._devices: Dict = {}
         self._connections: Dict[str, LGTVCommander] = {}
         self._online: List[str] = []
+        # Monotonic time of the last online status check, or None if it has never been checked.
+        self._online_checked: Optional[float] = None
+        # The volume and foreground app of each connected device, as reported by the device's subscriptions.
+        self._tv_state: Dict[str, Dict] = {}
+        self._probe_pool = ThreadPoolExecutor(thread_name_prefix="LGTVProbe")
+        # Concurrent online status checks share the probes in flight.
+        self._probes = SingleFlight()
+
+        # The queue of commands waiting to be sent to each device, indexed by name.
+        self._command_queues: Dict[str, CommandQueue] = {}
+
+        # Connection pool maintenance: per-device connect locks, and the reconnect backoff for each device.
+        self._connect_locks: Dict[str, threading.Lock] = {}
+        self._backoff: Dict[str, float] = {}
+        self._reconnect_at: Dict[str, float] = {}
+        self._stopping = threading.Event()
+        self._maintenance_thread: Optional[threading.Thread] = None
+        # Set to cut short the wait between passes of a background loop, so it picks up a new interval.
+        self._maintenance_wake = threading.Event()
+        # Guards starting the background loops, and their checks of whether to stop.
+        self._background_lock = threading.Lock()
+
+        # Discovery runs as a single background job. The last result is cached along with the time it finished.
+        self._discovery_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="LGTVDiscovery")
+        self._discovery_lock = threading.Lock()
+        self._discovery_job: Optional[Future] = None
+        self._discovery_result: Optional[Tuple[Dict[str, HostType], List[HostType]]] = None
+        self._discovery_error: Optional[str] = None
+        self._discovered_at: Optional[float] = None
+        self._discovery_thread: Optional[threading.Thread] = None
+        self._discovery_wake = threading.Event()
 
     def startup(self):
         # self._update_online_status()
-        pass
+        for name in self.devices:
+            self._publish(name)
+        self._start_background_loops()
+
+    def reconfigure(self, cfg: Optional[Dict]):
+        """
+        Start the connection pool maintenance or periodic discovery if they have been enabled, and wake them if
+        they are running, so they apply their new intervals straight away - or stop, if they have been disabled.
+        """
+        super().reconfigure(cfg)
+        self._start_background_loops()
+        self._maintenance_wake.set()
+        self._discovery_wake.set()
 
     def shutdown(self):
+        self._stopping.set()
+        self._maintenance_wake.set()
+        self._discovery_wake.set()
         self._disconnect_all()
+        self._probe_pool.shutdown(wait=False)
+        self._discovery_pool.shutdown(wait=False)
+
+    @property
+    def discovery_interval(self) -> float:
+        """
+        The number of seconds between background discoveries, from `adapters.LGTVAdapter.discovery_interval` in the
+        config. Zero or less disables periodic discovery - it then only runs when requested.
+        """
+        return self.cfg.get('discovery_interval', DEFAULT_DISCOVERY_INTERVAL)
+
+    @property
+    def keepalive_interval(self) -> float:
+        """
+        The number of seconds between keepalive checks of the connections to the paired TVs, from
+        `adapters.LGTVAdapter.keepalive_interval` in the config. Zero or less disables the background maintenance,
+        though paired TVs are still connected on demand.
+        """
+        return self.cfg.get('keepalive_interval', DEFAULT_KEEPALIVE_INTERVAL)
+
+    @property
+    def reconnect_max_backoff(self) -> float:
+        """
+        The upper limit, in seconds, of the backoff between attempts to reconnect to a TV, from
+        `adapters.LGTVAdapter.reconnect_max_backoff` in the config.
+        """
+        return self.cfg.get('reconnect_max_backoff', DEFAULT_RECONNECT_MAX_BACKOFF)
+
+    @property
+    def command_interval(self) -> float:
+        """
+        The minimum number of seconds between the commands sent to each TV, from
+        `adapters.LGTVAdapter.command_interval` in the config. Can be overridden for a TV in its section under
+        `devices`.
+        """
+        return self.cfg.get('command_interval', DEFAULT_COMMAND_INTERVAL)
+
+    @property
+    def input_idle_timeout(self) -> float:
+        """
+        The number of seconds a TV's pointer input socket is kept open after the last key press, from
+        `adapters.LGTVAdapter.input_idle_timeout` in the config.
+        """
+        return self.cfg.get('input_idle_timeout', DEFAULT_INPUT_IDLE_TIMEOUT)
+
+    @property
+    def probe_timeout(self) -> float:
+        """
+        The number of seconds to wait for each TV when checking whether it is online, from
+        `adapters.LGTVAdapter.probe_timeout` in the config.
+        """
+        return self.cfg.get('probe_timeout', DEFAULT_PROBE_TIMEOUT)
+
+    @property
+    def probe_ttl(self) -> float:
+        """
+        The number of seconds the online status is cached for, from `adapters.LGTVAdapter.probe_ttl` in the config.
+        """
+        return self.cfg.get('probe_ttl', DEFAULT_PROBE_TTL)
 
     @property
     def devices(self) -> Dict:
@@ -169,18 +543,20 @@ class LGTVAdapter(adapters.Adapter):
         Retrieve all the devices listed in the config.
 
         NOTE: Makes no guarantee of connection or validity.
-        :return: List of all devices from the config
+        :return: List of all devices from the config, which is added to the config if it has no devices section.
         """
-        return self.cfg['devices']
+        return self.cfg.setdefault('devices', {})
 
     @staticmethod
-    def _device_connect(name: str, ip: HostType, key: str = None) -> LGTVCommander:
+    def _device_connect(name: str, ip: HostType, key: str = None,
+                        input_idle_timeout: float = DEFAULT_INPUT_IDLE_TIMEOUT) -> LGTVCommander:
         """
         Connect to a WebOS LGTV client, check pairing status and attempt pairing if not paired.
 
         :param name: The human-readable name of the device
         :param ip:   The IP address for the device
         :param key:  The pairing key provided by the device. None if not paired.
+        :param input_idle_timeout: Seconds to keep the pointer input socket open after the last key press.
         :return: The connected & registered client.
         """
         client = WebOSClient(ip)
@@ -190,7 +566,7 @@ class LGTVAdapter(adapters.Adapter):
             store = {} if key is None else {'client_key': key}
 
             if key is None:
-                log.logger.info(f"LGTV {name} is not paired - attempting to pair.")
+                logger.info("LGTV %s is not paired - attempting to pair.", name)
 
             has_registered = False
             client_status = None
@@ -200,10 +576,12 @@ class LGTVAdapter(adapters.Adapter):
             if not has_registered:
                 raise LGTVException(f"Could not pair with LGTV {name} [Status: {client_status}].")
 
-            return LGTVCommander(client)
+            return LGTVCommander(client, store['client_key'], input_idle_timeout, name)
 
         except TimeoutError:
             raise LGTVException(f"Timed out connecting to LGTV {name}.")
+        except OSError as e:
+            raise LGTVException(f"Could not connect to LGTV {name}: {e}")
         except Exception as e:
             if str(e) == "Failed to register.":
                 raise LGTVException(f"Failed to pair LGTV {name}.")
@@ -215,32 +593,222 @@ class LGTVAdapter(adapters.Adapter):
         """
         c: LGTVCommander
         for c in self._connections.values():
-            c.client.close_connection()
+            c.close()
 
         self._connections.clear()
 
-    @staticmethod
-    def _ping_device_unix(name: str, ip: HostType) -> bool:
+    def _drop_connection(self, name: str):
+        """
+        Remove a device's connection from the pool, closing it if possible.
         """
-        Attempt to ping a given device to see if it is connected.
+        commander = self._connections.pop(name, None)
+        if commander is None:
+            return
 
-        :param name: The name of the device (used for debugging)
-        :param ip:   The IP address of the device to ping
-        :return:     True if the ping was successful, False otherwise.
+        self._tv_state.pop(name, None)
+        self._publish(name)
+
+        try:
+            commander.close()
+        except Exception as e:
+            logger.debug("Error closing connection to LGTV %s: %s", name, e)
 
-        # TODO: Unix only - this won't play ball on Windows due to argument. Should be less lazy and differentiate...
+    def _get_connection(self, name: str) -> LGTVCommander:
         """
-        ping = subprocess.Popen(["ping", "-c", "1", ip], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        out, error = ping.communicate()
-        groups = re.search(r"\d packets transmitted, (\d) packets received", out.decode())
+        Get a working connection to a device. Paired devices are connected on demand with their stored key if there
+        is no live connection in the pool. Unpaired devices must be connected with the connect endpoint first, as
+        pairing needs confirming on the TV.
 
-        if groups is None:
-            log.logger.warn(f"Could not parse `ping` output for LGTV [{name}] - unable to check connectivity")
-            log.logger.debug(out.decode())
-            return False
+        :param name: The name of the device.
+        :return: The connected commander.
+        """
+        commander = self._connections.get(name, None)
+        if commander is not None and commander.is_alive:
+            return commander
+
+        if name not in self.devices or 'key' not in self.devices[name]:
+            raise LGTVException(f"Device named {name} has not been connected.")
+
+        return self._reconnect(name)
+
+    def _reconnect(self, name: str) -> LGTVCommander:
+        """
+        Connect to a paired device with its stored key, replacing any dead connection in the pool. Only one connect
+        per device runs at a time - concurrent callers wait for it and share the result.
+
+        :param name: The name of the device.
+        :return: The connected commander.
+        """
+        with self._connect_lock(name):
+            commander = self._connections.get(name, None)
+            if commander is not None and commander.is_alive:
+                return commander
+
+            self._drop_connection(name)
+            data = self.devices[name]
+            commander = self._device_connect(name, data['host'], data['key'], self.input_idle_timeout)
+            self._install_connection(name, commander)
+            return commander
+
+    def _connect_lock(self, name: str) -> threading.Lock:
+        """
+        Get the lock that must be held to change a device's connection in the pool.
+        """
+        return self._connect_locks.setdefault(name, threading.Lock())
+
+    def _install_connection(self, name: str, commander: LGTVCommander):
+        """
+        Put a new connection to a device in the pool, closing any connection it replaces, and watch its state. Must
+        be called with the device's connect lock held.
+
+        :param name: The name of the device.
+        :param commander: The device's new connection.
+        """
+        self._drop_connection(name)
+        self._connections[name] = commander
+        self._watch(name, commander)
+        self._backoff.pop(name, None)
+        self._reconnect_at.pop(name, None)
+        logger.info("Connected to LGTV %s.", name)
+
+    def _watch(self, name: str, commander: LGTVCommander):
+        """
+        Subscribe to the state of a newly connected device, publishing it to the event stream as it changes.
+
+        :param name: The name of the device.
+        :param commander: The device's connection.
+        """
+        def on_change(changes: Dict):
+            if self._connections.get(name, None) is commander:
+                self._tv_state.setdefault(name, {}).update(changes)
+                self._publish(name)
+
+        self._publish(name)
+        try:
+            commander.subscribe_state(on_change)
+        except Exception as e:
+            logger.warning("Could not subscribe to the state of LGTV %s: %s", name, e)
 
-        log.logger.info(f"Pinged LGTV [{name}], is connected: {int(groups[1]) == 1}.")
-        return int(groups[1]) == 1
+    def _device_summary(self, name: str) -> Dict:
+        """
+        Build the API representation of a device - its connection status, and its volume and foreground app if it
+        is connected.
+
+        :param name: The name of the device.
+        :return: The device summary.
+        """
+        data = self.devices[name]
+        return {
+            'host': data['host'],
+            'paired': 'key' in data,
+            'online': name in self._online,
+            'connected': name in self._connections,
+            **self._tv_state.get(name, {})
+        }
+
+    def _publish(self, name: str):
+        """
+        Publish a device's summary to the event stream.
+
+        :param name: The name of the device.
+        """
+        if name in self.devices:
+            events.publish("lgtv", name, self._device_summary(name))
+
+    def _start_background_loops(self):
+        """
+        Start the connection pool maintenance and periodic discovery threads, if they are enabled and not already
+        running.
+        """
+        with self._background_lock:
+            if self._stopping.is_set():
+                return
+            if self.keepalive_interval > 0 and self._maintenance_thread is None:
+                self._maintenance_thread = threading.Thread(target=self._maintain_connections,
+                                                            name="LGTVConnectionPool", daemon=True)
+                self._maintenance_thread.start()
+            if self.discovery_interval > 0 and self._discovery_thread is None:
+                self._discovery_thread = threading.Thread(target=self._discover_periodically,
+                                                          name="LGTVPeriodicDiscovery", daemon=True)
+                self._discovery_thread.start()
+
+    def _keep_running(self, interval: float, thread_attr: str) -> bool:
+        """
+        Check whether a background loop should run another pass, clearing its thread if not, so that it can be
+        started again if it is re-enabled.
+
+        :param interval: The loop's current interval. Zero or less disables it.
+        :param thread_attr: The name of the attribute holding the loop's thread.
+        """
+        with self._background_lock:
+            if self._stopping.is_set() or interval <= 0:
+                setattr(self, thread_attr, None)
+                return False
+            return True
+
+    def _maintain_connections(self):
+        """
+        Background loop that keeps a warm connection to each paired device. Live connections are sent a keepalive,
+        and dead ones are dropped. Devices without a connection are reconnected, backing off exponentially (up to
+        the max backoff) while they are unreachable. Runs until the adapter shuts down, or the keepalive interval
+        is set to zero.
+        """
+        while self._keep_running(self.keepalive_interval, '_maintenance_thread'):
+            # Anything unexpected is logged and the pass retried, so that the pool is never left unmaintained
+            try:
+                self._maintain_pass()
+            except Exception:
+                logger.exception("LGTV connection pool maintenance failed")
+
+            self._maintenance_wake.wait(self.keepalive_interval)
+            self._maintenance_wake.clear()
+
+    def _maintain_pass(self):
+        """
+        Check the connection to each paired device once. See `_maintain_connections`.
+        """
+        for name, data in list(self.devices.items()):
+            if 'key' not in data or self._stopping.is_set():
+                continue
+
+            commander = self._connections.get(name, None)
+            if commander is not None:
+                if commander.is_alive and commander.ping(self.probe_timeout * 5):
+                    continue
+                logger.info("Connection to LGTV %s has died.", name)
+                self._drop_connection(name)
+
+            if time.monotonic() < self._reconnect_at.get(name, 0):
+                continue
+
+            try:
+                if not self._probe_device(name, data['host']):
+                    raise LGTVException(f"LGTV {name} is offline.")
+                self._reconnect(name)
+            except Exception as e:
+                backoff = self._backoff.get(name, self.keepalive_interval / 2) * 2
+                backoff = min(backoff, self.reconnect_max_backoff)
+                self._backoff[name] = backoff
+                self._reconnect_at[name] = time.monotonic() + backoff
+                logger.debug("Could not reconnect to LGTV %s, retrying in %ss: %s", name, backoff, e)
+
+    def _probe_device(self, name: str, ip: HostType) -> bool:
+        """
+        Check whether a given device is online, by opening (and immediately closing) a TCP connection to its webOS
+        port. This works on any platform and does not need to spawn a process.
+
+        :param name: The name of the device (used for debugging)
+        :param ip:   The IP address of the device to probe
+        :return:     True if the device accepted the connection within the probe timeout, False otherwise.
+        """
+        try:
+            with socket.create_connection((ip, WEBOS_PORT), timeout=self.probe_timeout):
+                is_online = True
+        except OSError:
+            is_online = False
+
+        logger.debug("Probed LGTV [%s], is online: %s.", name, is_online)
+        return is_online
 
     def _discover(self) -> Tuple[Dict[str, HostType], List[HostType]]:
         """
@@ -261,45 +829,149 @@ class LGTVAdapter(adapters.Adapter):
         :param hosts: All discovered hosts
         :return: A dict of existing host IP addresses (indexed by their name) and a list of new hosts.
         """
-        existing_hosts = {n: h for h in hosts for n, d in self.devices.items() if h == d['host']}
-        new_hosts = [h for h in hosts if h not in existing_hosts.values()]
+        names_by_host = {d['host']: n for n, d in self.devices.items()}
+        existing_hosts = {names_by_host[h]: h for h in hosts if h in names_by_host}
+        new_hosts = [h for h in hosts if h not in names_by_host]
 
         for n, h in existing_hosts.items():
-            log.logger.debug(f"Discovered device {h}, which is already configured as {n}")
+            logger.debug("Discovered device %s, which is already configured as %s", h, n)
 
         for h in new_hosts:
-            log.logger.debug(f"Discovered new device {h}.")
+            logger.debug("Discovered new device %s.", h)
 
         return existing_hosts, new_hosts
 
+    def _start_discovery(self) -> Future:
+        """
+        Start a discovery in the background, unless one is already running, in which case that one is returned.
+
+        :return: The future for the running discovery job.
+        """
+        with self._discovery_lock:
+            if self._discovery_job is None or self._discovery_job.done():
+                self._discovery_job = self._discovery_pool.submit(self._run_discovery)
+            return self._discovery_job
+
+    def _run_discovery(self):
+        """
+        Run a discovery and cache its result. Errors are cached too, and reported with the status.
+        """
+        try:
+            with metrics.discovery_duration.time(adapter="lgtv"):
+                self._discovery_result = self._discover()
+            self._discovery_error = None
+        except Exception as e:
+            logger.error("LGTV discovery failed: %s", e)
+            self._discovery_error = str(e)
+        self._discovered_at = time.monotonic()
+
+    def _discover_periodically(self):
+        """
+        Background loop that runs a discovery every discovery interval, until the adapter shuts down, or the
+        discovery interval is set to zero.
+        """
+        while self._keep_running(self.discovery_interval, '_discovery_thread'):
+            self._start_discovery().result()
+            self._discovery_wake.wait(self.discovery_interval)
+            self._discovery_wake.clear()
+
+    def _discovery_status(self) -> Dict:
+        """
+        Build the API representation of the discovery state - whether a discovery is running, and the cached result
+        of the last one, along with its age in seconds.
+        """
+        existing, new = self._discovery_result if self._discovery_result is not None else ({}, [])
+        job = self._discovery_job
+        return {
+            "running": job is not None and not job.done(),
+            "age": None if self._discovered_at is None else round(time.monotonic() - self._discovered_at, 3),
+            "error": self._discovery_error,
+            "existing_hosts": existing,
+            "new_hosts": new
+        }
+
     def _update_online_status(self):
         """
         Run through all hosts in the configuration and get the online status of each.
         Updates the member variable.
+
+        All hosts are probed at the same time, so this takes at most one probe timeout. The result is cached for the
+        probe TTL, and calls within that time return straight away. Calls made while the hosts are being probed wait
+        for those probes, rather than probing again.
         """
-        for n, d in self.devices.items():
-            if self._ping_device_unix(n, d['host']):
-                self._online.append(n)
-            else:
-                if n in self._online:
-                    self._online.remove(n)
-                if n in self._connections:
-                    del self._connections[n]
+        now = time.monotonic()
+        if self._online_checked is not None and now - self._online_checked < self.probe_ttl:
+            return
 
-    def _register_endpoints(self, app: FastAPI):
-        @app.get("/lgtv")
-        def get_devices() -> Dict:
-            def device_summary(name, data):
-                return {
-                    'host': data['host'],
-                    'paired': 'key' in data,
-                    'online': name in self._online,
-                    'connected': name in self._connections
-                }
+        self._probes.run(None, self._probe_devices)
+
+    def _probe_devices(self):
+        """
+        Probe all hosts, and update the online status. See `_update_online_status`.
+        """
+        now = time.monotonic()
+        names = list(self.devices)
+        results = self._probe_pool.map(lambda n: self._probe_device(n, self.devices[n]['host']), names)
+        self._online = [n for n, is_online in zip(names, results) if is_online]
+        self._online_checked = now
+
+        for n in names:
+            if n not in self._online:
+                self._drop_connection(n)
+            self._publish(n)
+
+    def _command_queue(self, name: str) -> CommandQueue:
+        """
+        Get the queue of commands for a device, applying its command interval.
+        """
+        queue = self._command_queues.setdefault(name, CommandQueue(f"LGTVCommands-{name}"))
+        queue.min_interval = self.devices.get(name, {}).get('command_interval', self.command_interval)
+        return queue
 
-            self._update_online_status()
+    def _send_command(self, name: str, command: CommandRequestModel) -> Union[str, Dict]:
+        """
+        Queue a command to be sent to a connected device. The commands for each device are sent one at a time,
+        spaced out by the command interval. A setter that is still waiting when another for the same setting is
+        queued (e.g. a volume slider being dragged) is replaced by it, and both return the response to the latest.
+
+        :param name: The name of the device.
+        :param command: The command.
+        :return: The response from the device.
+        """
+        def send():
+            return self._get_connection(name).send_command(command.name, command.message)
 
-            return {nm: device_summary(nm, data) for nm, data in self.devices.items()}
+        return self._command_queue(name).run(send, COMMAND_SETTINGS.get(command.name, None))
+
+    def _send_sequence(self, name: str, steps: List[SequenceStepModel], response: Response) -> Dict:
+        """
+        Queue a sequence of commands to be sent to a connected device, and build the endpoint response for it. The
+        sequence is sent as a single command, so no other commands are interleaved with it.
+        """
+        logger.info("Sending sequence of %d commands to device %s.", len(steps), name)
+
+        def send():
+            return self._get_connection(name).send_sequence((s.name, s.message, s.delay) for s in steps)
+
+        try:
+            return {"responses": self._command_queue(name).run(send)}
+        except LGTVException as e:
+            response.status_code = status.HTTP_400_BAD_REQUEST
+            return {"message": str(e)}
+
+    def _register_endpoints(self, app: FastAPI):
+        @app.get("/lgtv")
+        async def get_devices(response: Response,
+                              wait_for_change: float = Query(0, ge=0, le=events.MAX_WAIT_FOR_CHANGE),
+                              if_none_match: Optional[str] = Header(None)) -> Dict:
+            await events.wait_for_change("lgtv", None, if_none_match, wait_for_change)
+            # Probing blocks for up to the probe timeout, so keep it off the event loop
+            await run_in_threadpool(self._update_online_status)
+
+            not_modified = events.not_modified(response, if_none_match, "lgtv")
+            if not_modified is not None:
+                return not_modified
+            return {nm: self._device_summary(nm) for nm in self.devices}
 
         @app.put("/lgtv/{name}/connect")
         def connect_device(name: str, response: Response) -> Dict:
@@ -309,35 +981,70 @@ class LGTVAdapter(adapters.Adapter):
 
             try:
                 data = self.devices[name]
-                commander = self._device_connect(name, data['host'], data.get('key', None))
+                commander = self._device_connect(name, data['host'], data.get('key', None), self.input_idle_timeout)
 
-                key = commander.client.key
                 dev_cfg = config.get(f"adapters.LGTVAdapter.devices.{name}")
-                dev_cfg['key'] = key.decode()
-                config.save()
+                dev_cfg['key'] = commander.client_key
+                config.save_later()
 
-                self._connections[name] = commander
-                log.logger.info(f"Connected to LGTV {name}.")
+                with self._connect_lock(name):
+                    self._install_connection(name, commander)
                 return {"message": "Connected"}
             except LGTVException as e:
                 response.status_code = status.HTTP_400_BAD_REQUEST
                 return {"message": str(e)}
 
-        @app.post("/lgtv/discover")
+        @app.post("/lgtv/discover", status_code=status.HTTP_202_ACCEPTED)
         def discover_device() -> Dict:
-            existing, new = self._discover()
-            return {
-                "existing_hosts": existing,
-                "new_hosts": new
-            }
+            self._start_discovery()
+            return self._discovery_status()
+
+        @app.get("/lgtv/discover")
+        def discovery_status() -> Dict:
+            return self._discovery_status()
 
         @app.post("/lgtv/{name}/command")
         def send_command(name: str, command: CommandRequestModel, response: Response):
+            logger.info("Sending command [%s: %s] to device %s.", command.name, command.message, name)
+
+            try:
+                return {"response": self._send_command(name, command)}
+            except LGTVException as e:
+                response.status_code = status.HTTP_400_BAD_REQUEST
+                return {"message": str(e)}
+
+        @app.get("/lgtv/{name}/apps")
+        def list_apps(name: str, response: Response, refresh: bool = False):
+            try:
+                return {"apps": self._get_connection(name).get_apps(refresh).apps}
+            except LGTVException as e:
+                response.status_code = status.HTTP_400_BAD_REQUEST
+                return {"message": str(e)}
+
+        @app.delete("/lgtv/{name}/apps")
+        def invalidate_apps(name: str, response: Response):
             if name not in self._connections:
                 response.status_code = status.HTTP_400_BAD_REQUEST
                 return {"message": f"Device named {name} has not been connected."}
 
-            log.logger.info(f"Sending command [{command.name}: {command.message}] to device {name}.")
+            self._connections[name].invalidate_apps()
+            return {"message": "App list cleared"}
+
+        @app.post("/lgtv/{name}/sequence")
+        def send_sequence(name: str, steps: List[SequenceStepModel], response: Response):
+            return self._send_sequence(name, steps, response)
+
+        @app.post("/lgtv/{name}/macros/{macro}")
+        def run_macro(name: str, macro: str, response: Response):
+            macros = self.cfg.get('macros', {})
+            if macro not in macros:
+                response.status_code = status.HTTP_400_BAD_REQUEST
+                return {"message": f"Macro named {macro} has not been configured."}
+
+            try:
+                steps = [SequenceStepModel(**step) for step in macros[macro]]
+            except ValidationError as e:
+                response.status_code = status.HTTP_400_BAD_REQUEST
+                return {"message": f"Macro named {macro} is not valid: {e}"}
 
-            client: LGTVCommander = self._connections[name]
-            return {"response": client.send_command(command.name, command.message)}
+            return self._send_sequence(name, steps, response)
@@ -0,0 +1,517 @@
+import asyncio
+import json
+import os
+import queue
+import socket
+import sqlite3
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi import FastAPI, status
+from fastapi.responses import JSONResponse, Response
+from starlette.datastructures import Headers
+from starlette.middleware.cors import CORSMiddleware
+
+from under_control import adapters
+import under_control.config as config
+import under_control.events as events
+import under_control.logger as log
+from under_control.utils import EventLoopThread
+
+# Default number of HTTP worker processes. With more than one, this process holds the device connections and serves
+# the workers (see `start_owner`), and the workers serve the API (see `WorkerApp`).
+DEFAULT_WORKERS: int = 1
+
+# Default path of the SQLite database the device states are shared with the workers through.
+DEFAULT_STORE_PATH: str = "under_control_state.db"
+
+# Default path of the Unix socket the workers forward requests to the owner over.
+DEFAULT_SOCKET_PATH: str = "under_control.sock"
+
+# Seconds between checks of which adapters keep their state up to date in the background, while nothing changes.
+ADAPTER_CHECK_INTERVAL: float = 1.0
+
+# The largest message that can be sent over the socket, in bytes.
+MESSAGE_LIMIT: int = 16 * 1024 * 1024
+
+# The workers are started as new processes, so the owner passes them the path of its config in this environment
+# variable.
+CONFIG_PATH_ENV: str = "UNDER_CONTROL_CONFIG"
+
+# A change to the published states, as (adapter name, device name, state or None if removed, adapter ETag,
+# device ETag), or None to stop the store writer.
+ChangeType = Optional[Tuple[str, str, Optional[Dict], str, str]]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS adapters (adapter TEXT PRIMARY KEY, etag TEXT NOT NULL, cached INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS devices (adapter TEXT NOT NULL, device TEXT NOT NULL, state TEXT NOT NULL,
+                                    etag TEXT NOT NULL, PRIMARY KEY (adapter, device));
+"""
+
+
+class ClusterException(Exception):
+    pass
+
+
+def _setting(name: str, default: Any) -> Any:
+    try:
+        return config.get(f"cluster.{name}")
+    except config.ConfigException:
+        return default
+
+
+def num_workers() -> int:
+    """
+    The number of HTTP worker processes to serve the API from, from `cluster.workers` in the config.
+    """
+    return _setting("workers", DEFAULT_WORKERS)
+
+
+class StateStore:
+    """
+    The published device states, shared between the processes in SQLite. The owner writes them and the workers read
+    them. The database is in WAL mode, so the workers' reads don't block on the owner's writes, or each other.
+
+    :param path: The path of the database file.
+    :param read_only: Only allow reads, as the workers do.
+    """
+
+    def __init__(self, path: str, read_only: bool = False):
+        # Transactions are begun explicitly, so that each batch of writes (or each read) is atomic
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        if read_only:
+            self._db.execute("PRAGMA query_only = ON")
+        else:
+            self._db.execute("PRAGMA journal_mode = WAL")
+            self._db.execute("PRAGMA synchronous = NORMAL")
+            self._db.executescript(_SCHEMA)
+
+    def close(self):
+        self._db.close()
+
+    def clear(self):
+        """
+        Remove all the states, e.g. those left by a previous run, whose ETags would never match again.
+        """
+        self._db.executescript("BEGIN; DELETE FROM adapters; DELETE FROM devices; COMMIT;")
+
+    def write(self, changes: List[ChangeType], cached: Dict[str, bool]):
+        """
+        Apply a batch of changes in a single transaction.
+
+        :param changes: The changes to the published states, in the order they were made.
+        :param cached: Whether each adapter keeps its state up to date in the background, indexed by adapter name.
+        """
+        self._db.execute("BEGIN")
+        try:
+            for adapter, device, state, adapter_etag, device_etag in changes:
+                if state is None:
+                    self._db.execute("DELETE FROM devices WHERE adapter = ? AND device = ?", (adapter, device))
+                else:
+                    self._db.execute("INSERT OR REPLACE INTO devices VALUES (?, ?, ?, ?)",
+                                     (adapter, device, json.dumps(state, separators=(",", ":")), device_etag))
+                self._db.execute("INSERT OR REPLACE INTO adapters VALUES (?, ?, ?)",
+                                 (adapter, adapter_etag, cached.get(adapter, False)))
+            self._db.executemany("UPDATE adapters SET cached = ? WHERE adapter = ?",
+                                 [(is_cached, adapter) for adapter, is_cached in cached.items()])
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        self._db.execute("COMMIT")
+
+    def listing(self, adapter: str) -> Optional[Tuple[str, bool, List[Tuple[str, str]]]]:
+        """
+        Read the states of all an adapter's devices.
+
+        :param adapter: The name of the adapter.
+        :return: The adapter's ETag, whether its state is kept up to date, and the name and JSON state of each of
+                 its devices; or None if it hasn't published anything.
+        """
+        self._db.execute("BEGIN")
+        try:
+            row = self._db.execute("SELECT etag, cached FROM adapters WHERE adapter = ?", (adapter,)).fetchone()
+            if row is None:
+                return None
+            devices = self._db.execute("SELECT device, state FROM devices WHERE adapter = ? ORDER BY device",
+                                       (adapter,)).fetchall()
+        finally:
+            self._db.execute("COMMIT")
+        return row[0], bool(row[1]), devices
+
+    def device(self, adapter: str, device: str) -> Optional[Tuple[str, bool, str]]:
+        """
+        Read the state of a single device.
+
+        :param adapter: The name of the adapter.
+        :param device: The name of the device.
+        :return: The device's ETag, whether its adapter's state is kept up to date, and its JSON state; or None if
+                 it hasn't been published.
+        """
+        row = self._db.execute("SELECT d.etag, a.cached, d.state FROM devices d JOIN adapters a USING (adapter) "
+                               "WHERE adapter = ? AND device = ?", (adapter, device)).fetchone()
+        return None if row is None else (row[0], bool(row[1]), row[2])
+
+
+def _text(value: bytes) -> str:
+    # Headers and bodies are bytes, which are sent over the socket as JSON strings, one character per byte
+    return value.decode("latin-1")
+
+
+def _bytes(value: str) -> bytes:
+    return value.encode("latin-1")
+
+
+def _encode_request(scope: Dict, body: bytes) -> bytes:
+    return json.dumps({
+        "http_version": scope["http_version"],
+        "method": scope["method"],
+        "scheme": scope["scheme"],
+        "path": scope["path"],
+        "query_string": _text(scope["query_string"]),
+        "headers": [[_text(k), _text(v)] for k, v in scope["headers"]],
+        "client": scope.get("client", None),
+        "server": scope.get("server", None),
+        "body": _text(body),
+    }).encode() + b"\n"
+
+
+def _decode_request(line: bytes) -> Tuple[Dict, bytes]:
+    request = json.loads(line)
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": request["http_version"],
+        "method": request["method"],
+        "scheme": request["scheme"],
+        "path": request["path"],
+        "root_path": "",
+        "query_string": _bytes(request["query_string"]),
+        "headers": [(_bytes(k), _bytes(v)) for k, v in request["headers"]],
+        "client": None if request["client"] is None else tuple(request["client"]),
+        "server": None if request["server"] is None else tuple(request["server"]),
+    }
+    return scope, _bytes(request["body"])
+
+
+def _encode_message(message: Dict) -> bytes:
+    if message["type"] == "http.response.start":
+        message = {**message, "headers": [[_text(k), _text(v)] for k, v in message.get("headers", [])]}
+    else:
+        message = {**message, "body": _text(message.get("body", b""))}
+    return json.dumps(message).encode() + b"\n"
+
+
+def _decode_message(line: bytes) -> Dict:
+    message = json.loads(line)
+    if message["type"] == "http.response.start":
+        message["headers"] = [(_bytes(k), _bytes(v)) for k, v in message["headers"]]
+    else:
+        message["body"] = _bytes(message["body"])
+    return message
+
+
+class _Owner:
+    """
+    The process that holds the device connections. Every change to the published states is copied to the shared
+    store, and requests forwarded by the workers are run against the full app.
+    """
+
+    def __init__(self, app: FastAPI, store_path: str, socket_path: str):
+        self.app = app
+        self.socket_path = socket_path
+        self.store = StateStore(store_path)
+
+        self._changes: "queue.Queue[ChangeType]" = queue.Queue()
+        self._writer = threading.Thread(target=self._write_changes, name="ClusterStoreWriter", daemon=True)
+        self._runner = EventLoopThread("ClusterOwner")
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    def start(self):
+        # A socket left by a previous run would stop the server binding, but one that is in use must be left alone
+        if os.path.exists(self.socket_path):
+            if _is_listening(self.socket_path):
+                raise ClusterException(f"Another process is already serving workers on {self.socket_path}")
+            os.remove(self.socket_path)
+
+        self.store.clear()
+        events.add_observer(self._observe)
+        self._writer.start()
+
+        self._runner.start()
+        self._server = self._runner.run(asyncio.start_unix_server(self._serve_connection, self.socket_path,
+                                                                  limit=MESSAGE_LIMIT))
+
+    def stop(self):
+        events.remove_observer(self._observe)
+        self._changes.put(None)
+        self._writer.join()
+
+        self._server.close()
+        self._runner.run(self._server.wait_closed())
+        self._runner.stop()
+        os.remove(self.socket_path)
+        self.store.close()
+
+    def _observe(self, adapter: str, device: str, state: Optional[Dict], adapter_etag: str, device_etag: str):
+        # Called with the events lock held, so the writes are left to the writer thread
+        self._changes.put((adapter, device, state, adapter_etag, device_etag))
+
+    def _write_changes(self):
+        """
+        Write the changes to the store as they are published, batching up any that arrive during a write. Also
+        keeps track of which adapters' states are kept up to date, which can change without anything being
+        published, e.g. when a poller is turned off.
+        """
+        cached = {}
+        while True:
+            try:
+                changes = [self._changes.get(timeout=ADAPTER_CHECK_INTERVAL)]
+            except queue.Empty:
+                changes = []
+            while not self._changes.empty():
+                changes.append(self._changes.get_nowait())
+
+            stopping = None in changes
+            changes = [c for c in changes if c is not None]
+            now_cached = {nm: adapters.get(nm).state_is_cached for nm in adapters.names()}
+            if changes or now_cached != cached:
+                try:
+                    self.store.write(changes, now_cached)
+                    cached = now_cached
+                except sqlite3.Error:
+                    log.logger.exception("Failed to write device states to the shared store")
+
+            if stopping:
+                return
+
+    async def _serve_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Run a request forwarded by a worker against the app. The request is sent as a single line of JSON, and each
+        of the app's response messages is sent back the same way. If the worker closes the connection, e.g. when
+        its client disconnects from the event stream, the app is told that the client has disconnected.
+        """
+        try:
+            scope, body = _decode_request(await reader.readline())
+        except (ValueError, KeyError):
+            writer.close()
+            return
+
+        body_received = False
+
+        async def receive() -> Dict:
+            nonlocal body_received
+            if not body_received:
+                body_received = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            # The worker sends nothing more, so this waits for it to close the connection
+            await reader.read()
+            return {"type": "http.disconnect"}
+
+        async def send(message: Dict):
+            writer.write(_encode_message(message))
+            await writer.drain()
+
+        try:
+            await self.app(scope, receive, send)
+        except ConnectionError:
+            pass
+        except Exception:
+            log.logger.exception("Failed to handle forwarded request for %s", scope['path'])
+        finally:
+            writer.close()
+
+
+def _is_listening(socket_path: str) -> bool:
+    with socket.socket(socket.AF_UNIX) as sock:
+        try:
+            sock.connect(socket_path)
+        except OSError:
+            return False
+    return True
+
+
+# The owner, while this process is running as one.
+_owner: Optional[_Owner] = None
+
+
+def start_owner(app: FastAPI):
+    """
+    Run this process as the owner of the devices, for a set of HTTP workers serving `worker_app`. The published
+    device states are copied to the shared store (`cluster.store` in the config) for the workers to read, and the
+    requests they forward are served on a Unix socket (`cluster.socket`).
+
+    Must be called once the adapters have been created, and before the workers are started. Raises a
+    ClusterException if another owner is already using the socket.
+
+    :param app: The FastAPI app, with the adapters' endpoints registered, to run forwarded requests against.
+    """
+    global _owner
+    owner = _Owner(app, _setting("store", DEFAULT_STORE_PATH), _setting("socket", DEFAULT_SOCKET_PATH))
+    owner.start()
+    _owner = owner
+
+    # Inherited by the worker processes, so they load the same config
+    os.environ[CONFIG_PATH_ENV] = os.path.abspath(config.get('__file_path'))
+    log.logger.info(f"Serving workers from the shared store {_setting('store', DEFAULT_STORE_PATH)} and the socket "
+                    f"{_owner.socket_path}")
+
+
+def stop_owner():
+    """
+    Stop serving the workers, and close the shared store.
+    """
+    global _owner
+    if _owner is not None:
+        _owner.stop()
+        _owner = None
+
+
+async def _wait_for_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+class WorkerApp:
+    """
+    The ASGI app served by each HTTP worker. It holds no devices itself: reads of the device listings (e.g.
+    `GET /kasa` and `GET /kasa/{alias}`) are answered from the shared store, with the same ETags the owner would
+    give, for the adapters that keep their state up to date in the background. Every other request, including
+    `?fresh=true` reads, commands and the event stream, is forwarded to the owner.
+
+    The listings served from the store are the published states, so they leave out the `age` of the Kasa states.
+    """
+
+    def __init__(self):
+        self._app = self._handle
+        self._store: Optional[StateStore] = None
+        self._socket_path = DEFAULT_SOCKET_PATH
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self._app(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                try:
+                    self._setup()
+                except Exception as e:
+                    await send({"type": "lifespan.startup.failed", "message": str(e)})
+                    return
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self._store is not None:
+                    self._store.close()
+                log.stop_logger()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def _setup(self):
+        config.load(os.environ[CONFIG_PATH_ENV])
+        log.setup_logger(config.get('logging'))
+
+        self._store = StateStore(_setting("store", DEFAULT_STORE_PATH), read_only=True)
+        self._socket_path = _setting("socket", DEFAULT_SOCKET_PATH)
+
+        # The owner's app isn't served directly, so CORS is handled here instead
+        try:
+            cors_origins = config.get("cors_origins")
+        except config.ConfigException:
+            cors_origins = None
+        if cors_origins:
+            self._app = CORSMiddleware(self._handle, allow_origins=cors_origins, allow_credentials=True,
+                                       allow_methods=["*"], allow_headers=["*"])
+
+    async def _handle(self, scope, receive, send):
+        response = None
+        if scope["method"] == "GET" and not scope["query_string"]:
+            response = self._read_state(scope)
+
+        if response is None:
+            await self._forward(scope, receive, send)
+        else:
+            await response(scope, receive, send)
+
+    def _read_state(self, scope) -> Optional[Response]:
+        """
+        Answer a request for an adapter's device listing (`/{adapter}`), or a single device (`/{adapter}/{device}`),
+        from the store.
+
+        :return: The response, or None if the request must be forwarded to the owner.
+        """
+        parts = scope["path"].strip("/").split("/")
+        if len(parts) == 1:
+            listing = self._store.listing(parts[0])
+            if listing is None:
+                return None
+            etag, cached, devices = listing
+            # The states are stored as JSON, so they are joined up as they are rather than parsed and re-encoded
+            body = "{" + ",".join(f"{json.dumps(device)}:{state}" for device, state in devices) + "}"
+        elif len(parts) == 2:
+            device = self._store.device(parts[0], parts[1])
+            if device is None:
+                return None
+            etag, cached, body = device
+        else:
+            return None
+
+        if not cached:
+            return None
+        if events.etag_matches(Headers(scope=scope).get("if-none-match", None), etag):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+        return Response(body, media_type="application/json", headers={"ETag": etag})
+
+    async def _forward(self, scope, receive, send):
+        """
+        Forward a request to the owner, and relay its response - streaming it, if the owner streams it.
+        """
+        body = b""
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+        try:
+            reader, writer = await asyncio.open_unix_connection(self._socket_path, limit=MESSAGE_LIMIT)
+        except OSError as e:
+            log.logger.error("Could not forward request for %s to the owner: %s", scope['path'], e)
+            response = JSONResponse({"message": "The device owner is not available"},
+                                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+            await response(scope, receive, send)
+            return
+
+        # Closing the connection when the client disconnects ends the relay below, and tells the owner
+        disconnected = asyncio.ensure_future(_wait_for_disconnect(receive))
+        disconnected.add_done_callback(lambda _: writer.close())
+
+        started = client_gone = False
+        try:
+            writer.write(_encode_request(scope, body))
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                message = _decode_message(line)
+                started = started or message["type"] == "http.response.start"
+                await send(message)
+                if message["type"] == "http.response.body" and not message.get("more_body", False):
+                    break
+        except (OSError, ValueError) as e:
+            log.logger.error("Lost the connection to the owner forwarding request for %s: %s", scope['path'], e)
+        finally:
+            client_gone = disconnected.done()
+            disconnected.cancel()
+            writer.close()
+
+        if not started and not client_gone:
+            response = JSONResponse({"message": "The device owner did not respond"},
+                                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+            await response(scope, receive, send)
+
+
+# The app the HTTP workers serve, by its import path, when the API runs with multiple workers.
+worker_app = WorkerApp()
@@ -1,9 +1,52 @@
-from typing import AnyStr, Optional, Any
+import copy
+import os
+import stat
+import tempfile
+import threading
+from typing import AnyStr, Callable, Dict, List, Optional, Any
 
 import toml
 
+import under_control.logger as log
+
 _config = {}
 
+# Marks a path that has not been memoised yet, as None is a valid config value.
+_MISSING = object()
+
+# Memoised results of `get`, indexed by item path. Cleared whenever the config is changed through this module.
+_resolved: Dict[str, Any] = {}
+
+# Bumped whenever the memo is cleared, so that a value resolved before a clear is not stored after it. Guarded, along
+# with stores to the memo, by the lock.
+_resolved_generation: int = 0
+_resolved_lock = threading.Lock()
+
+# Callbacks to fire when the value at a path changes on reload, indexed by the item path.
+_listeners: Dict[str, List[Callable[[Any], None]]] = {}
+
+# Default number of seconds between checks of the config file for changes, when watching it.
+DEFAULT_WATCH_INTERVAL: float = 2.0
+
+# Set to stop the file watcher thread, if it is running.
+_stop_watching = threading.Event()
+
+# Default number of seconds `save_later` waits for further changes before writing the config file.
+DEFAULT_SAVE_DELAY: float = 1.0
+
+# Number of times to try copying the config to serialise it, if it is changed in place while being copied.
+SERIALISE_ATTEMPTS: int = 5
+
+# Serialises writes to the config file, and guards the write-behind state below.
+_save_lock = threading.RLock()
+
+# The serialised config as last written to (or read from) each file path, used to skip writes that change nothing.
+_last_saved = {}
+
+# The pending write-behind save, if any, as a timer and the file path it will write to.
+_pending_save: Optional[threading.Timer] = None
+_pending_path: Optional[str] = None
+
 
 class ConfigException(Exception):
     def __init__(self, message: AnyStr):
@@ -22,13 +65,34 @@ def get(item_path: AnyStr) -> Any:
     # TODO: Handle list indexing - currently only digs into dicts. Workaround is to retrieve the list and index
     from the caller.
 
+    Resolved paths are memoised, so repeated lookups of the same path are a single dict lookup. The memo is
+    cleared by `set`, `load`, `save` and reloads - if a value returned by `get` is modified in place, follow it with
+    one of those.
+
     :param item_path: The dot-separated path to the config item
     :return: The value at the path (could
     """
+    # A single lookup, as other threads may clear the memo at any time
+    value = _resolved.get(item_path, _MISSING)
+    if value is not _MISSING:
+        return value
 
-    if _config == {}:
+    if not _config:
         raise ConfigException("Config is empty - has the app setup run?")
 
+    generation = _resolved_generation
+    value = _resolve(item_path)
+    with _resolved_lock:
+        # If the config changed while resolving, the value may be out of date, so it is not memoised
+        if generation == _resolved_generation:
+            _resolved[item_path] = value
+    return value
+
+
+def _resolve(item_path: AnyStr) -> Any:
+    """
+    Walk the config to the item at the given path. See `get`.
+    """
     pieces = item_path.split('.')
     ptr = _config
     for p in pieces:
@@ -43,6 +107,37 @@ def get(item_path: AnyStr) -> Any:
     return ptr
 
 
+def _clear_resolved():
+    """
+    Clear the memo of resolved paths, after the config has changed.
+    """
+    global _resolved_generation
+    with _resolved_lock:
+        _resolved_generation += 1
+        _resolved.clear()
+
+
+def set(item_path: AnyStr, value: Any):
+    """
+    Set the config item at the given path (see `get`), creating any missing interim dicts along the way.
+
+    If an interim value exists but is not a dict, this will throw a ConfigException.
+
+    :param item_path: The dot-separated path to the config item
+    :param value: The value to store at the path
+    """
+    *pieces, last = item_path.split('.')
+    ptr = _config
+    for p in pieces:
+        ptr = ptr.setdefault(p, {})
+
+        if not isinstance(ptr, dict):
+            raise ConfigException(f"Could not set config item {item_path} [{p}] - can only examine dict entries.")
+
+    ptr[last] = value
+    _clear_resolved()
+
+
 def load(file_path: AnyStr):
     """
     Load the config from the TOML file at the given file path. Updates the module-level config dict with the
@@ -55,6 +150,115 @@ def load(file_path: AnyStr):
     with open(file_path) as fh:
         _config.update(toml.load(fh))
     _config['__file_path'] = file_path
+    _clear_resolved()
+
+    with _save_lock:
+        _last_saved[file_path] = _serialise()
+
+
+def _merge_in_place(target: Dict, source: Dict):
+    """
+    Update a dict in place so that it equals another, recursing into nested dicts rather than replacing them. This
+    keeps references that adapters hold to their config sections valid across a reload.
+    """
+    for k in [k for k in target if k not in source and not k.startswith('__')]:
+        del target[k]
+
+    for k, v in source.items():
+        if isinstance(v, dict) and isinstance(target.get(k, None), dict):
+            _merge_in_place(target[k], v)
+        else:
+            target[k] = v
+
+
+def on_change(item_path: AnyStr, callback: Callable[[Any], None]):
+    """
+    Register a callback to be fired with the new value whenever the value at the given path changes on a reload.
+
+    :param item_path: The dot-separated path to the config item, e.g. 'adapters.KasaAdapter'.
+    :param callback: Function called with the new value, or None if the item has been removed.
+    """
+    _listeners.setdefault(item_path, []).append(callback)
+
+
+def reload():
+    """
+    Re-read the config file the config was loaded from, and merge it into the current config in place. Edits in
+    the file replace any changes that have not been saved yet.
+
+    Callbacks registered with `on_change` are fired for each watched path whose value has changed.
+    """
+    file_path = _config['__file_path']
+    with open(file_path) as fh:
+        new_config = toml.load(fh)
+
+    def snapshot(item_path):
+        try:
+            return copy.deepcopy(_resolve(item_path))
+        except ConfigException:
+            return None
+
+    with _save_lock:
+        before = {path: snapshot(path) for path in _listeners}
+        _merge_in_place(_config, new_config)
+        _clear_resolved()
+        _last_saved[file_path] = _serialise()
+
+    log.logger.info(f"Reloaded config from {file_path}")
+
+    for path, callbacks in _listeners.items():
+        value = snapshot(path)
+        if value != before[path]:
+            for callback in callbacks:
+                callback(value)
+
+
+def watch(interval: float = DEFAULT_WATCH_INTERVAL):
+    """
+    Start a background thread that checks the config file for changes every `interval` seconds, and reloads it
+    when it has been modified. See `reload`.
+
+    :param interval: Number of seconds between checks.
+    """
+    file_path = _config['__file_path']
+    _stop_watching.clear()
+
+    def watch_file():
+        last_modified = os.stat(file_path).st_mtime_ns
+        while not _stop_watching.wait(interval):
+            try:
+                modified = os.stat(file_path).st_mtime_ns
+                if modified != last_modified:
+                    last_modified = modified
+                    reload()
+            except Exception as e:
+                log.logger.error(f"Could not reload config from {file_path}: {e}")
+
+    threading.Thread(target=watch_file, name="ConfigWatcher", daemon=True).start()
+
+
+def stop_watching():
+    """
+    Stop the file watcher thread started by `watch`, if it is running.
+    """
+    _stop_watching.set()
+
+
+def _serialise() -> str:
+    """
+    Serialise the current config to TOML, removing any internal state vars (prefixed by `__`).
+
+    Request handlers change the config in place without holding a lock, so it is copied first, and the copy is
+    serialised. A change during the copy fails it, so it is retried.
+    """
+    for attempt in range(SERIALISE_ATTEMPTS):
+        try:
+            content = copy.deepcopy({k: v for k, v in _config.items() if not k.startswith('__')})
+            break
+        except RuntimeError:
+            if attempt == SERIALISE_ATTEMPTS - 1:
+                raise
+    return toml.dumps(content)
 
 
 def save(file_path: Optional[str] = None):
@@ -65,11 +269,79 @@ def save(file_path: Optional[str] = None):
     loaded.
 
     Removes any internal state vars that might have been added to the config file (prefixed by `__`).
+
+    The file is written to a temporary file alongside it, which is then renamed over it, so that readers (and
+    crashes) never see a partly written file. The file keeps its permissions. Nothing is written if the config has not changed since it was last
+    loaded or saved.
     :param file_path:
     :return:
     """
     if file_path is None:
         file_path = _config['__file_path']
 
-    with open(file_path, 'w') as fh:
-        toml.dump({k: v for k, v in _config.items() if not k.startswith('__')}, fh)
+    _clear_resolved()
+    with _save_lock:
+        content = _serialise()
+        if _last_saved.get(file_path, None) == content:
+            return
+
+        directory, name = os.path.split(os.path.abspath(file_path))
+        fd, tmp_path = tempfile.mkstemp(prefix=f".{name}.", suffix=".tmp", dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as fh:
+                fh.write(content)
+                fh.flush()
+                os.fsync(fh.fileno())
+            # The temporary file is only readable by its owner, so give it the permissions of the file it replaces
+            if os.path.exists(file_path):
+                os.chmod(tmp_path, stat.S_IMODE(os.stat(file_path).st_mode))
+            os.replace(tmp_path, file_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        _last_saved[file_path] = content
+
+
+def save_later(file_path: Optional[str] = None, delay: float = DEFAULT_SAVE_DELAY):
+    """
+    Save the config in the background, off the calling thread (see `save`).
+
+    The write waits for `delay` seconds, and any further calls in that time push it back, so a burst of changes
+    results in a single write. Use `flush` to write a pending save straight away.
+
+    :param file_path: Path to the config file. If not provided, the file the config was loaded from is used.
+    :param delay: Number of seconds to wait for further changes before writing.
+    """
+    global _pending_save, _pending_path
+
+    if file_path is None:
+        file_path = _config['__file_path']
+
+    _clear_resolved()
+    with _save_lock:
+        if _pending_save is not None:
+            _pending_save.cancel()
+            if _pending_path != file_path:
+                save(_pending_path)
+
+        _pending_path = file_path
+        _pending_save = threading.Timer(delay, flush)
+        _pending_save.daemon = True
+        _pending_save.start()
+
+
+def flush():
+    """
+    Write any pending background save straight away. Should be called before the app exits.
+    """
+    global _pending_save, _pending_path
+
+    with _save_lock:
+        if _pending_save is None:
+            return
+
+        _pending_save.cancel()
+        file_path = _pending_path
+        _pending_save = _pending_path = None
+        save(file_path)
@@ -0,0 +1,306 @@
+import asyncio
+import copy
+import json
+import threading
+import uuid
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from fastapi import FastAPI, Query, Response, status
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+
+import under_control.config as config
+
+# Default number of seconds between keepalive comments on an idle event stream, so proxies don't close it.
+DEFAULT_KEEPALIVE_INTERVAL: float = 15.0
+
+# Default number of events buffered for each listener. A listener that falls this far behind is sent a new snapshot.
+DEFAULT_QUEUE_SIZE: int = 1000
+
+# The longest a client may wait for a change with `?wait_for_change=`, in seconds.
+MAX_WAIT_FOR_CHANGE: float = 300.0
+
+# The last published state of each device, indexed by adapter name, then device name.
+_states: Dict[str, Dict[str, Dict]] = {}
+
+# The state version of each adapter, incremented whenever the state of any of its devices changes, indexed by adapter
+# name. The version of each device is the version of its adapter when it last changed, indexed by adapter name, then
+# device name.
+_versions: Dict[str, int] = {}
+_device_versions: Dict[str, Dict[str, int]] = {}
+
+# Identifies this run of the server in ETags, as the versions restart from zero.
+_epoch: str = uuid.uuid4().hex[:8]
+
+# The listeners to the event streams.
+_listeners: List["_Listener"] = []
+
+# Called with every change to the published states, as (adapter name, device name, state or None if removed, adapter
+# ETag, device ETag).
+_observers: List[Callable[[str, str, Optional[Dict], str, str], None]] = []
+
+# The requests waiting for a change, as (adapter name, device name or None for any device, loop, future).
+_waiters: List[Tuple[str, Optional[str], asyncio.AbstractEventLoop, asyncio.Future]] = []
+
+# Guards the states and listeners, so that each listener sees a snapshot followed by every change after it.
+_lock = threading.Lock()
+
+
+def _diff(old: Any, new: Any) -> Any:
+    """
+    Build a JSON merge patch (RFC 7386) that turns one value into another: the changed keys of a dict, with nested
+    dicts patched recursively and removed keys set to None. Any other value is replaced outright.
+
+    :return: The patch, or an empty dict if nothing has changed.
+    """
+    if not isinstance(old, dict) or not isinstance(new, dict):
+        return new
+
+    patch = {k: None for k in old if k not in new}
+    for k, v in new.items():
+        if k not in old:
+            patch[k] = v
+        elif old[k] != v:
+            patch[k] = _diff(old[k], v)
+    return patch
+
+
+def publish(adapter: str, device: str, state: Optional[Dict]):
+    """
+    Publish the current state of a device. If it has changed since it was last published, the state version of the
+    adapter and device are bumped, and the changes are sent to every listener. Can be called from any thread.
+
+    :param adapter: The name of the adapter, e.g. 'kasa'.
+    :param device: The name of the device.
+    :param state: The state of the device, which must be JSON serialisable (or encodable by FastAPI), or None if the
+                  device has been removed.
+    """
+    state = None if state is None else jsonable_encoder(state)
+
+    with _lock:
+        device_states = _states.setdefault(adapter, {})
+        if state is None:
+            if device_states.pop(device, None) is None:
+                return
+            event = {"adapter": adapter, "device": device, "removed": True}
+        else:
+            changes = _diff(device_states.get(device, None), state)
+            if not changes:
+                return
+            device_states[device] = state
+            event = {"adapter": adapter, "device": device, "changes": changes}
+
+        _versions[adapter] = _versions.get(adapter, 0) + 1
+        _device_versions.setdefault(adapter, {})[device] = _versions[adapter]
+
+        for listener in _listeners:
+            listener.push(event)
+
+        for observer in _observers:
+            observer(adapter, device, state, _format_etag(_versions[adapter]),
+                     _format_etag(_device_versions[adapter][device]))
+
+        for waiter in [w for w in _waiters if w[0] == adapter and w[1] in (None, device)]:
+            _waiters.remove(waiter)
+            waiter[2].call_soon_threadsafe(_wake, waiter[3])
+
+
+def _wake(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+def add_observer(observer: Callable[[str, str, Optional[Dict], str, str], None]):
+    """
+    Call a function with every change to the published states, e.g. to copy them elsewhere. It is first called with
+    the current state of every device, so it misses nothing. It is called with the lock held, from whichever thread
+    published the change, so it should return quickly, and must not publish itself.
+
+    :param observer: Called with the adapter name, device name, new state (or None if the device has been removed),
+                     and the new ETags of the adapter and the device.
+    """
+    with _lock:
+        for adapter, device_states in _states.items():
+            adapter_etag = _format_etag(_versions.get(adapter, 0))
+            for device, state in device_states.items():
+                device_etag = _format_etag(_device_versions.get(adapter, {}).get(device, 0))
+                observer(adapter, device, state, adapter_etag, device_etag)
+        _observers.append(observer)
+
+
+def remove_observer(observer: Callable[[str, str, Optional[Dict], str, str], None]):
+    with _lock:
+        _observers.remove(observer)
+
+
+def _format_etag(version: int) -> str:
+    return f'W/"{_epoch}-{version}"'
+
+
+def etag(adapter: str, device: Optional[str] = None) -> str:
+    """
+    Get a weak ETag for the current state of an adapter's devices, or of a single device. It changes whenever the
+    published state does, so it can be used to answer conditional requests.
+
+    :param adapter: The name of the adapter.
+    :param device: The name of the device, or None for all of the adapter's devices.
+    :return: The ETag.
+    """
+    with _lock:
+        if device is None:
+            version = _versions.get(adapter, 0)
+        else:
+            version = _device_versions.get(adapter, {}).get(device, 0)
+    return _format_etag(version)
+
+
+def etag_matches(if_none_match: Optional[str], current: str) -> bool:
+    """
+    Check an If-None-Match header against an ETag, using the weak comparison.
+
+    :param if_none_match: The header value, which may list several ETags, or be '*'.
+    :param current: The current ETag.
+    :return: True if the header matches, so a 304 can be returned.
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+
+    def opaque(tag: str) -> str:
+        tag = tag.strip()
+        return tag[2:] if tag.startswith("W/") else tag
+
+    return opaque(current) in {opaque(tag) for tag in if_none_match.split(",")}
+
+
+def not_modified(response: Response, if_none_match: Optional[str], adapter: str,
+                 device: Optional[str] = None) -> Optional[Response]:
+    """
+    Answer a conditional GET: set the current ETag on the endpoint's response, and if the client's copy is still
+    current, build an empty 304 response to return instead.
+
+    :param response: The endpoint's response.
+    :param if_none_match: The client's If-None-Match header.
+    :param adapter: The name of the adapter.
+    :param device: The name of the device, or None if the response covers all of the adapter's devices.
+    :return: The 304 response, or None if the full response should be returned.
+    """
+    current = etag(adapter, device)
+    if etag_matches(if_none_match, current):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": current})
+    response.headers["ETag"] = current
+    return None
+
+
+async def wait_for_change(adapter: str, device: Optional[str], if_none_match: Optional[str], timeout: float):
+    """
+    Long-poll support: if the client's ETag is still current, wait until the state changes, or the timeout passes.
+    Returns straight away if there is no timeout, or the client's ETag is already out of date. Must be awaited on
+    the server's event loop.
+
+    :param adapter: The name of the adapter.
+    :param device: The name of the device, or None to wait for a change to any of the adapter's devices.
+    :param if_none_match: The client's If-None-Match header.
+    :param timeout: The longest number of seconds to wait.
+    """
+    if timeout <= 0 or not if_none_match:
+        return
+
+    loop = asyncio.get_event_loop()
+    waiter = (adapter, device, loop, loop.create_future())
+    with _lock:
+        _waiters.append(waiter)
+
+    try:
+        # Checked after registering the waiter, so a change in between can't be missed
+        if etag_matches(if_none_match, etag(adapter, device)):
+            await asyncio.wait_for(waiter[3], timeout)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        with _lock:
+            if waiter in _waiters:
+                _waiters.remove(waiter)
+
+
+class _Listener:
+    """
+    A client of the event stream. Events are queued on the server's event loop, to be sent by the stream. If the
+    client falls too far behind, its queue is replaced by a new snapshot.
+    """
+
+    def __init__(self, adapters: Optional[List[str]], queue_size: int):
+        self.adapters = None if not adapters else frozenset(adapters)
+        self.loop = asyncio.get_event_loop()
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+
+    def snapshot(self) -> Dict:
+        """
+        Copy the current states for this listener's adapters. Must be called with the lock held.
+        """
+        return {nm: copy.deepcopy(states) for nm, states in _states.items()
+                if self.adapters is None or nm in self.adapters}
+
+    def push(self, event: Dict):
+        if self.adapters is None or event["adapter"] in self.adapters:
+            self.loop.call_soon_threadsafe(self._put, event)
+
+    def _put(self, event: Dict):
+        try:
+            self.queue.put_nowait(("change", event))
+        except asyncio.QueueFull:
+            with _lock:
+                while not self.queue.empty():
+                    self.queue.get_nowait()
+                self.queue.put_nowait(("snapshot", self.snapshot()))
+
+
+def _format_event(name: str, data: Any) -> str:
+    return f"event: {name}\ndata: {json.dumps(data)}\n\n"
+
+
+async def _stream(listener: _Listener, keepalive_interval: float) -> AsyncIterator[str]:
+    with _lock:
+        _listeners.append(listener)
+        snapshot = listener.snapshot()
+
+    try:
+        yield _format_event("snapshot", snapshot)
+        while True:
+            try:
+                name, data = await asyncio.wait_for(listener.queue.get(), keepalive_interval)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            yield _format_event(name, data)
+    finally:
+        with _lock:
+            _listeners.remove(listener)
+
+
+def _setting(name: str, default: Any) -> Any:
+    try:
+        return config.get(f"events.{name}")
+    except config.ConfigException:
+        return default
+
+
+def setup(app: FastAPI):
+    """
+    Register the `/events` endpoint, which streams device state changes as Server-Sent Events.
+
+    Each client is first sent a `snapshot` event with the current state of every device, indexed by adapter and
+    device name. Then each change is sent as a `change` event, holding the adapter and device names and either a
+    JSON merge patch of the `changes` to the device's state, or `removed: true`. The states are built from the
+    adapters' caches as they are refreshed or changed, so clients add no load on the devices.
+
+    :param app: The FastAPI app instance.
+    """
+
+    @app.get("/events")
+    async def stream_events(adapters: Optional[List[str]] = Query(None)) -> StreamingResponse:
+        listener = _Listener(adapters, _setting("queue_size", DEFAULT_QUEUE_SIZE))
+        keepalive_interval = _setting("keepalive_interval", DEFAULT_KEEPALIVE_INTERVAL)
+        return StreamingResponse(_stream(listener, keepalive_interval), media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache"})
@@ -1,14 +1,131 @@
-import sys
+import copy
+import json
 import logging
-from typing import AnyStr
+import logging.handlers
+import queue
+import sys
+from typing import Dict, Optional
 
 logger = logging.getLogger()
 
+# The formats log records can be written in, from `logging.format` in the config.
+TEXT_FORMAT: str = "text"
+JSON_FORMAT: str = "json"
+
+DATE_FORMAT: str = '%Y-%m-%d %H:%M:%S'
+
+# The handler installed on the root logger by `setup_logger`, and the listener writing out its queue, if queued.
+_handler: Optional[logging.Handler] = None
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class LoggerException(Exception):
+    pass
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Formats each record as a JSON object on a single line, for log collectors to parse.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record, self.datefmt),
+            "logger": record.name,
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        elif record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """
+    Queues records for the listener to format. Unlike the stock handler, which formats them on the logging thread
+    and folds any traceback into the message, this only merges each message with its arguments, and renders the
+    traceback into `exc_text`, so the listener's formatter still sees them separately.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+            # The traceback holds on to every frame, so it isn't kept on the queue
+            record.exc_info = None
+        return record
+
+
+def _formatter(log_format: str) -> logging.Formatter:
+    if log_format == TEXT_FORMAT:
+        return logging.Formatter('%(asctime)s %(name)s %(levelname)s %(message)s', DATE_FORMAT)
+    if log_format == JSON_FORMAT:
+        return JSONFormatter(datefmt=DATE_FORMAT)
+    raise LoggerException(f"Unknown log format [{log_format}], expected '{TEXT_FORMAT}' or '{JSON_FORMAT}'")
 
-def setup_logger(log_level: AnyStr):
-    logger.setLevel(log_level)
+
+def setup_logger(cfg: Dict):
+    """
+    Set up the root logger to write to stdout, replacing any handler from an earlier call.
+
+    In queued mode, records are put on a queue by the thread that logs them, and written out by a background
+    listener, so request threads and event loops never block on stdout. Their messages are still merged with their
+    arguments when they are logged, so they show the state at the time.
+
+    :param cfg: The `logging` section of the config, holding the `level`, the `format` ('text' or 'json') and whether
+                to write records from a background thread (`queued`).
+    """
+    global _handler, _listener
+    stop_logger()
+
+    logger.setLevel(cfg.get('level', 'INFO'))
     out_handler = logging.StreamHandler(sys.stdout)
-    out_handler.setFormatter(
-        logging.Formatter('%(asctime)s %(name)s %(levelname)s %(message)s', '%Y-%m-%d %H:%M:%S')
-    )
-    logger.addHandler(out_handler)
+    out_handler.setFormatter(_formatter(cfg.get('format', TEXT_FORMAT)))
+
+    if cfg.get('queued', False):
+        log_queue = queue.SimpleQueue()
+        _listener = logging.handlers.QueueListener(log_queue, out_handler, respect_handler_level=True)
+        _listener.start()
+        _handler = _QueueHandler(log_queue)
+    else:
+        _handler = out_handler
+    logger.addHandler(_handler)
+
+
+def stop_logger():
+    """
+    Write out any queued records and remove the handler installed by `setup_logger`.
+    """
+    global _handler, _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+    if _handler is not None:
+        logger.removeHandler(_handler)
+        _handler = None
+
+
+def get_logger(name: str) -> logging.Logger:
+    """
+    Get the logger for part of the app, such as an adapter. Its records are written by the root logger's handler,
+    and it has the root logger's level unless it has been given its own (see `set_level`).
+
+    :param name: The name shown in each record, e.g. the adapter class name.
+    """
+    return logging.getLogger(name)
+
+
+def set_level(name: str, level: Optional[str]):
+    """
+    Set the level of a logger from `get_logger`, so that records below it are dropped before their messages are
+    built.
+
+    :param name: The name of the logger.
+    :param level: The level name, e.g. 'DEBUG', or None to use the root logger's level.
+    """
+    get_logger(name).setLevel(logging.NOTSET if level is None else level)
@@ -0,0 +1,283 @@
+import asyncio
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
+
+# Default histogram buckets, in seconds - from a fast local call up to a slow device timing out.
+DEFAULT_BUCKETS: Tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+LabelValues = Tuple[str, ...]
+
+INF_LABEL = 'le="+Inf"'
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    """
+    Base class for the metrics. Each metric has a set of label names, and keeps a value for each combination of
+    label values it is given. Metrics are thread-safe, and add themselves to the registry when created.
+    """
+    type_name: str = "untyped"
+
+    def __init__(self, name: str, description: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _label_values(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels[n]) for n in self.label_names)
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError()
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.type_name}"] + self._samples()
+
+
+class Counter(Metric):
+    type_name = "counter"
+
+    def __init__(self, name: str, description: str, label_names: Sequence[str] = ()):
+        super().__init__(name, description, label_names)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str):
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.label_names, k)} {v}" for k, v in values]
+
+
+class Gauge(Metric):
+    """
+    A value that can go up and down. If a function is given, it is called at collection time instead, and should
+    return the value for each combination of label values.
+    """
+    type_name = "gauge"
+
+    def __init__(self, name: str, description: str, label_names: Sequence[str] = (),
+                 function: Optional[Callable[[], Dict[LabelValues, float]]] = None):
+        super().__init__(name, description, label_names)
+        self._values: Dict[LabelValues, float] = {}
+        self._function = function
+
+    def inc(self, amount: float = 1.0, **labels: str):
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels: str):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels: str):
+        with self._lock:
+            self._values[self._label_values(labels)] = value
+
+    def _samples(self) -> List[str]:
+        if self._function is not None:
+            values = list(self._function().items())
+        else:
+            with self._lock:
+                values = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.label_names, k)} {v}" for k, v in values]
+
+
+class Histogram(Metric):
+    type_name = "histogram"
+
+    def __init__(self, name: str, description: str, label_names: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, description, label_names)
+        self.buckets = tuple(sorted(buckets))
+        # For each combination of label values: the count in each bucket (not cumulative), the sum and the count.
+        self._values: Dict[LabelValues, Tuple[List[int], float, int]] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self._label_values(labels)
+        with self._lock:
+            counts, total, count = self._values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for i, upper in enumerate(self.buckets):
+                if value <= upper:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value, count + 1)
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """
+        Time the body of the `with` block and observe the duration, whether or not it raises.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            values = [(k, list(counts), total, count) for k, (counts, total, count) in self._values.items()]
+
+        samples = []
+        for k, counts, total, count in values:
+            cumulative = 0
+            for upper, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = _format_labels(self.label_names, k, f'le="{upper}"')
+                samples.append(f"{self.name}_bucket{le} {cumulative}")
+            samples.append(f"{self.name}_bucket{_format_labels(self.label_names, k, INF_LABEL)} {count}")
+            samples.append(f"{self.name}_sum{_format_labels(self.label_names, k)} {total}")
+            samples.append(f"{self.name}_count{_format_labels(self.label_names, k)} {count}")
+        return samples
+
+
+# All the metrics that have been created, in creation order.
+_registry: List[Metric] = []
+
+
+def render() -> str:
+    """
+    Render all the metrics in the Prometheus text exposition format.
+    """
+    return "\n".join(line for metric in _registry for line in metric.render()) + "\n"
+
+
+request_duration = Histogram("under_control_request_duration_seconds",
+                             "Time taken to handle HTTP requests, by route.", ("method", "route"))
+requests_total = Counter("under_control_requests_total",
+                         "HTTP requests handled, by route and response status.", ("method", "route", "status"))
+requests_in_progress = Gauge("under_control_requests_in_progress",
+                             "HTTP requests currently being handled, by method.", ("method",))
+
+device_call_duration = Histogram("under_control_device_call_duration_seconds",
+                                 "Time taken by calls to devices, by adapter, operation and device.",
+                                 ("adapter", "operation", "device"))
+device_call_errors = Counter("under_control_device_call_errors_total",
+                             "Calls to devices that raised an error, by adapter, operation and device.",
+                             ("adapter", "operation", "device"))
+discovery_duration = Histogram("under_control_discovery_duration_seconds",
+                               "Time taken by device discovery, by adapter.", ("adapter",),
+                               buckets=(0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0))
+
+
+@contextmanager
+def device_call(adapter: str, operation: str, device: str) -> Iterator[None]:
+    """
+    Time a call to a device, and count it as an error if it raises. Works around awaits, e.g.
+
+        with metrics.device_call("kasa", "update", alias):
+            await dev.update()
+
+    :param adapter: The name of the adapter making the call.
+    :param operation: The operation, e.g. 'update' or 'turn_on'.
+    :param device: The name of the device.
+    """
+    labels = {"adapter": adapter, "operation": operation, "device": device}
+    try:
+        with device_call_duration.time(**labels):
+            yield
+    except BaseException:
+        device_call_errors.inc(**labels)
+        raise
+
+
+def _threadpool_stats() -> Dict[LabelValues, float]:
+    """
+    Inspect the event loop's default executor, which runs the sync endpoints. Must be called on the event loop.
+    """
+    try:
+        executor = getattr(asyncio.get_event_loop(), '_default_executor', None)
+    except RuntimeError:
+        executor = None
+    if executor is None:
+        return {}
+    return {
+        ("max_workers",): executor._max_workers,
+        ("workers",): len(executor._threads),
+        ("queued",): executor._work_queue.qsize(),
+    }
+
+
+threadpool = Gauge("under_control_threadpool",
+                   "Size and backlog of the threadpool that runs the sync endpoints.", ("stat",), _threadpool_stats)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware that records the latency, status and concurrency of the HTTP requests, labelled by the path
+    template of the route that handled them (e.g. '/kasa/{alias}'), to keep the number of label values bounded.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._route_paths: Dict[Callable, str] = {}
+
+    def _route_path(self, scope) -> str:
+        endpoint = scope.get("endpoint", None)
+        if endpoint is None:
+            return "unmatched"
+
+        if endpoint not in self._route_paths:
+            for route in scope["app"].router.routes:
+                if getattr(route, "endpoint", None) is endpoint:
+                    self._route_paths[endpoint] = route.path
+                    break
+            else:
+                return "unmatched"
+        return self._route_paths[endpoint]
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        response_status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                response_status[0] = message["status"]
+            await send(message)
+
+        method = scope["method"]
+        requests_in_progress.inc(method=method)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            requests_in_progress.dec(method=method)
+            route = self._route_path(scope)
+            request_duration.observe(time.perf_counter() - started, method=method, route=route)
+            requests_total.inc(method=method, route=route, status=str(response_status[0]))
+
+
+def setup(app: FastAPI):
+    """
+    Add the request metrics middleware to the app, and register the `/metrics` endpoint.
+
+    :param app: The FastAPI app instance.
+    """
+    app.add_middleware(MetricsMiddleware)
+
+    # Async, so it runs on the event loop and can inspect its threadpool
+    @app.get("/metrics", response_class=PlainTextResponse)
+    async def get_metrics() -> PlainTextResponse:
+        return PlainTextResponse(render(), media_type="text/plain; version=0.0.4")
@@ -1,4 +1,12 @@
+import asyncio
+import concurrent.futures
+import json
+import threading
+import time
 from enum import Enum
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional
+
+from fastapi.responses import JSONResponse
 
 
 # The following code is CC BY-SA 4.0 by licensed as per Stack Overflow's conditions
@@ -7,3 +15,285 @@ from enum import Enum
 class AutoName(Enum):
     def _generate_next_value_(name, start, count, last_values):
         return name.lower()
+
+
+class EventLoopThread:
+    """
+    Runs a single, long-lived asyncio event loop on a dedicated daemon thread.
+
+    Asyncio-based device libraries keep connections and locks bound to the loop they were created on, so running
+    all of their coroutines on one loop lets those be reused between requests. Coroutines can be submitted from
+    synchronous code (`run`), or awaited from another event loop, such as the server's (`submit`).
+    """
+
+    def __init__(self, name: str):
+        self.loop: asyncio.AbstractEventLoop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run_loop, name=name, daemon=True)
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the loop, wait for its thread to finish and close it. Any pending coroutines are abandoned.
+        """
+        if not self._thread.is_alive():
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+    def run(self, coro: Awaitable, timeout: Optional[float] = None) -> Any:
+        """
+        Run a coroutine on the loop and block until it completes. Must not be called from the loop's own thread.
+
+        :param coro: The coroutine to run.
+        :param timeout: Optional number of seconds to wait for the result.
+        :return: The coroutine's result.
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    def spawn(self, coro: Awaitable) -> concurrent.futures.Future:
+        """
+        Schedule a coroutine on the loop without waiting for it, e.g. for a long-running background task.
+
+        :param coro: The coroutine to run.
+        :return: A future for the coroutine's result. Cancelling it cancels the coroutine.
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def submit(self, coro: Awaitable) -> Any:
+        """
+        Run a coroutine on the loop and await its result from the calling event loop, without blocking it.
+
+        :param coro: The coroutine to run.
+        :return: The coroutine's result.
+        """
+        if asyncio.get_running_loop() is self.loop:
+            return await coro
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, self.loop))
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls of the same operation from different threads. A call made while the operation for
+    the same key is already running waits for that one to finish and shares its result (or exception), rather than
+    running it again - so a burst of identical requests costs a single round of device I/O.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._in_flight: Dict[Hashable, concurrent.futures.Future] = {}
+
+    def run(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        """
+        Run an operation, or wait for the one for the same key that is already running.
+
+        :param key: Identifies the operation.
+        :param fn: Runs the operation, if it isn't already running.
+        :return: The operation's result.
+        """
+        with self._lock:
+            future = self._in_flight.get(key, None)
+            is_leader = future is None
+            if is_leader:
+                future = self._in_flight[key] = concurrent.futures.Future()
+
+        if not is_leader:
+            return future.result()
+
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+
+class AsyncSingleFlight:
+    """
+    Coalesces concurrent calls of the same coroutine on an event loop, as `SingleFlight` does for threads. Must only
+    be used from the one loop.
+    """
+
+    def __init__(self):
+        self._in_flight: Dict[Hashable, asyncio.Future] = {}
+
+    async def run(self, key: Hashable, coro_fn: Callable[[], Awaitable]) -> Any:
+        """
+        Run a coroutine, or wait for the one for the same key that is already running. The shared coroutine isn't
+        cancelled if a caller waiting for it is cancelled, as the others still want its result.
+
+        :param key: Identifies the operation.
+        :param coro_fn: Creates the coroutine, if it isn't already running.
+        :return: The coroutine's result.
+        """
+        future = self._in_flight.get(key, None)
+        if future is None or future.done():
+            future = self._in_flight[key] = asyncio.ensure_future(coro_fn())
+
+            def forget(done: asyncio.Future):
+                if self._in_flight.get(key, None) is done:
+                    del self._in_flight[key]
+
+            future.add_done_callback(forget)
+        return await asyncio.shield(future)
+
+
+class _QueuedCommand:
+    def __init__(self, kind: Optional[Hashable], fn: Callable, future):
+        self.kind = kind
+        self.fn = fn
+        self.future = future
+
+
+class CommandQueue:
+    """
+    Runs the commands for a single device one at a time, in the order they were queued, on a worker thread that is
+    started whenever there are commands waiting. Callers can be on any thread.
+
+    A command queued with a `kind` replaces any command of the same kind that is still waiting, and takes its place
+    at the back of the queue, so a burst of setters (e.g. from a slider) only sends the latest value. The callers of
+    replaced commands get the result of the command that replaced them. Commands can also be spaced out, to limit
+    the rate they are sent at - more of them are then replaced while they wait.
+
+    :param name: The name of the worker thread.
+    :param min_interval: The minimum number of seconds between the starts of consecutive commands.
+    """
+
+    def __init__(self, name: str, min_interval: float = 0.0):
+        self.name = name
+        self.min_interval = min_interval
+
+        self._lock = threading.Lock()
+        self._pending: List[_QueuedCommand] = []
+        self._worker: Optional[threading.Thread] = None
+        self._last_started: Optional[float] = None
+
+    def run(self, fn: Callable[[], Any], kind: Optional[Hashable] = None) -> Any:
+        """
+        Queue a command and block until it (or the command that replaced it) has run.
+
+        :param fn: Runs the command.
+        :param kind: The kind of setting the command changes, or None if it must not be replaced.
+        :return: The command's result.
+        """
+        with self._lock:
+            command = _take_pending(self._pending, kind, fn, concurrent.futures.Future)
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._work, name=self.name, daemon=True)
+                self._worker.start()
+        return command.future.result()
+
+    def _work(self):
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._worker = None
+                    return
+
+            if self._last_started is not None:
+                delay = self._last_started + self.min_interval - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+            with self._lock:
+                command = self._pending.pop(0)
+            self._last_started = time.monotonic()
+
+            try:
+                command.future.set_result(command.fn())
+            except BaseException as e:
+                command.future.set_exception(e)
+
+
+class AsyncCommandQueue:
+    """
+    Runs the commands for a single device one at a time on an event loop, as `CommandQueue` does for threads. Must
+    only be used from the one loop.
+
+    :param min_interval: The minimum number of seconds between the starts of consecutive commands.
+    """
+
+    def __init__(self, min_interval: float = 0.0):
+        self.min_interval = min_interval
+
+        self._pending: List[_QueuedCommand] = []
+        self._worker: Optional[asyncio.Task] = None
+        self._last_started: Optional[float] = None
+
+    async def run(self, coro_fn: Callable[[], Awaitable], kind: Optional[Hashable] = None) -> Any:
+        """
+        Queue a command and wait until it (or the command that replaced it) has run. Cancelling the wait doesn't
+        cancel the command.
+
+        :param coro_fn: Creates the coroutine that runs the command.
+        :param kind: The kind of setting the command changes, or None if it must not be replaced.
+        :return: The command's result.
+        """
+        loop = asyncio.get_running_loop()
+        command = _take_pending(self._pending, kind, coro_fn, loop.create_future)
+        if self._worker is None:
+            self._worker = asyncio.ensure_future(self._work())
+        return await asyncio.shield(command.future)
+
+    async def _work(self):
+        while self._pending:
+            if self._last_started is not None:
+                delay = self._last_started + self.min_interval - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+            command = self._pending.pop(0)
+            self._last_started = time.monotonic()
+
+            try:
+                command.future.set_result(await command.fn())
+            except Exception as e:
+                command.future.set_exception(e)
+        self._worker = None
+
+
+def _take_pending(pending: List[_QueuedCommand], kind: Optional[Hashable], fn: Callable,
+                  create_future: Callable[[], Any]) -> _QueuedCommand:
+    """
+    Add a command to the back of a queue. If a command of the same kind is waiting, it is moved to the back instead,
+    and made to run the new command, so that its callers get the result of the new one.
+
+    :return: The queued command.
+    """
+    if kind is not None:
+        for i, command in enumerate(pending):
+            if command.kind == kind:
+                del pending[i]
+                command.fn = fn
+                pending.append(command)
+                return command
+
+    command = _QueuedCommand(kind, fn, create_future())
+    pending.append(command)
+    return command
+
+
+# Shared by every CompactJSONResponse, as `json.dumps` with options builds a new encoder on each call.
+_compact_encoder = json.JSONEncoder(ensure_ascii=False, allow_nan=False, separators=(",", ":"), check_circular=False)
+
+
+class CompactJSONResponse(JSONResponse):
+    """
+    A JSON response for content that is already made of plain JSON types, such as prebuilt snapshots of device
+    state. Returning it from an endpoint skips FastAPI's `jsonable_encoder` pass over the content, and it is encoded
+    without whitespace or a check for circular references.
+    """
+
+    def render(self, content: Any) -> bytes:
+        return _compact_encoder.encode(content).encode("utf-8")